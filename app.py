@@ -1,9 +1,19 @@
-import os, time, re, json, requests
+import os, io, time, re, gzip, json, html, queue, signal, sqlite3, hashlib, argparse, threading, requests
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from datetime import datetime, timezone, timedelta
-from sqlalchemy import create_engine, text
+from decimal import Decimal, InvalidOperation
+from typing import Iterator
+from sqlalchemy import create_engine, event, exc as sa_exc, text, bindparam
+from sqlalchemy.pool import QueuePool
 from dotenv import load_dotenv
 from apscheduler.schedulers.blocking import BlockingScheduler
+from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_SCHEDULER_STARTED
+import numpy as np
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 
 # ------------------- Yüklemeler ve ortam -------------------
 load_dotenv()
@@ -16,7 +26,6 @@ else:
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 assert DATABASE_URL, "DATABASE_URL boş!"
-engine = create_engine(DATABASE_URL, echo=False)
 B=os.getenv('TEST_TOKEN')
 EBAY_MARKETPLACE_ID = os.getenv("EBAY_MARKETPLACE_ID", "EBAY_GB")
 EBAY_CLIENT_ID = os.getenv("EBAY_CLIENT_ID")
@@ -32,34 +41,313 @@ def _mask(s: str, keep: int = 6) -> str:
         return "<empty>"
     return s[:keep] + "…" if len(s) > keep else s
 
+def _utcnow() -> datetime:
+    """DB'deki TIMESTAMP sütunlarıyla uyumlu, tz'siz UTC zamanı."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 print(f"[Env] TELEGRAM_BOT_TOKEN={_mask(TELEGRAM_BOT_TOKEN)}", flush=True)
 print(f"[Env] TELEGRAM_CHAT_ID={TELEGRAM_CHAT_ID or '<empty>'}", flush=True)
 
 
-def send_telegram_message(text: str):
-    """Basit Telegram gönderici."""
+# ------------------- Hız sınırlama -------------------
+class TokenBucket:
+    """Thread-safe token bucket: saniyede `rate` istek, en fazla `capacity` patlama."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def penalize(self, seconds: float):
+        """Sunucu kota/429 döndüğünde tüm istemcileri `seconds` boyunca bekletir."""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def acquire(self, n: int = 1):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    delay = self._blocked_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= n:
+                        self._tokens -= n
+                        return
+                    delay = (n - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+# ------------------- HTTP istemcisi -------------------
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+# requests: ayrı havuz tutulan host sayısı (eBay API, eBay OAuth, Telegram)
+HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "4"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "0") == "1"
+
+
+class HttpClient:
+    """Tüm dış çağrılar (eBay, Telegram) için ortak istemci.
+
+    Host başına keep-alive bağlantı havuzu tutar; böylece her çağrıda yeni
+    TCP+TLS el sıkışması yapılmaz. HTTP2_ENABLED=1 ve httpx[http2] kuruluysa
+    HTTP/2 kullanılır, değilse requests.Session.
+    """
+
+    def __init__(self, pool_size: int, connect_timeout: float, read_timeout: float, http2: bool = False,
+                 pool_hosts: int = HTTP_POOL_HOSTS):
+        self.timeout = (connect_timeout, read_timeout)
+        self.http2 = False
+        headers = {"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"}
+        if http2:
+            try:
+                import httpx
+                import h2  # noqa: F401  (httpx HTTP/2 desteği için gerekli)
+                self._client = httpx.Client(
+                    http2=True, headers=headers,
+                    limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+                    timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                )
+                self.http2 = True
+                return
+            except ImportError:
+                print("[HTTP] httpx[http2] yok; HTTP/1.1 kullanılıyor", flush=True)
+        self._client = requests.Session()
+        self._client.headers.update(headers)
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size)
+        self._client.mount("https://", adapter)
+        self._client.mount("http://", adapter)
+
+    def request(self, method: str, url: str, timeout=None, **kw):
+        if self.http2:
+            # Verilmezse istemcinin httpx.Timeout'u (ayrı bağlantı süresiyle) geçerlidir
+            if timeout is not None:
+                import httpx
+                kw["timeout"] = httpx.Timeout(timeout, connect=self.timeout[0])
+        else:
+            kw["timeout"] = timeout or self.timeout
+        return self._client.request(method, url, **kw)
+
+    def get(self, url: str, **kw):
+        return self.request("GET", url, **kw)
+
+    def post(self, url: str, **kw):
+        return self.request("POST", url, **kw)
+
+    def close(self):
+        self._client.close()
+
+
+http_client = HttpClient(HTTP_POOL_SIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP2_ENABLED)
+
+
+# Telegram sohbet başına sınırlar: ~1 mesaj/sn, grupta dakikada 20 mesaj
+telegram_rate_limiter = TokenBucket(1.0, 1)
+telegram_minute_limiter = TokenBucket(20 / 60, 20)
+
+
+def send_telegram_message(text: str) -> bool:
+    """Basit Telegram gönderici; hız sınırına uyar, başarılıysa True döner."""
     if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
         print("[Telegram] token veya chat_id yok, mesaj atlanıyor.", flush=True)
-        return
+        return False
     if not TELEGRAM_CHAT_ID:
         print("[Telegram] TELEGRAM_CHAT_ID yok! Mesaj atlanıyor.", flush=True)
-        return
+        return False
     url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
     payload = {
         "chat_id": TELEGRAM_CHAT_ID,
         "text": text,
         "parse_mode": "HTML"
     }
+    telegram_minute_limiter.acquire()
+    telegram_rate_limiter.acquire()
     try:
-        r = requests.post(url, json=payload, timeout=10)
+        r = http_client.post(url, json=payload, timeout=10)
+        if r.status_code == 429:
+            retry_after = (r.json().get("parameters") or {}).get("retry_after", 5)
+            print(f"[Telegram] 429, {retry_after}s bekleniyor", flush=True)
+            telegram_rate_limiter.penalize(retry_after)
+            return False
         if r.status_code != 200:
             print(f"[Telegram] hata: {r.text}", flush=True)
+            return False
+        return True
     except Exception as e:
         print(f"[Telegram] gönderim hatası: {e}", flush=True)
+        return False
+
+# ------------------- Veritabanı bağlantıları -------------------
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))        # saniye, boş bağlantı bekleme
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))        # saniye; proxy/LB boşta kesmeden önce
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "300000"))
+DB_APPLICATION_NAME = os.getenv("DB_APPLICATION_NAME", "ebay-worker")
+# Ingest havuzu: eşzamanlı sorgu yazımları kadar bağlantı yeter
+DB_INGEST_POOL_SIZE = int(os.getenv("DB_INGEST_POOL_SIZE", "4"))
+# Ingest oturumunda synchronous_commit=off: çökmede son birkaç yüz ms'lik
+# commit kaybolabilir, bir sonraki yoklama aynı ilanları yeniden yazar
+DB_INGEST_ASYNC_COMMIT = os.getenv("DB_INGEST_ASYNC_COMMIT", "1") == "1"
+
+
+class PoolMetrics:
+    """Bağlantı havuzu sayaçları: checkout sayısı, bekleme süresi, zaman aşımı, geçersizleşen bağlantı."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.invalidated = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_wait(self, seconds: float, ok: bool):
+        with self._lock:
+            if ok:
+                self.checkouts += 1
+                self.wait_total += seconds
+                self.wait_max = max(self.wait_max, seconds)
+            else:
+                self.timeouts += 1
+
+    def record_invalidated(self):
+        with self._lock:
+            self.invalidated += 1
+
+    def snapshot(self, pool) -> dict:
+        with self._lock:
+            return {
+                "size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "idle": pool.checkedin(),
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "invalidated": self.invalidated,
+                "wait_avg_ms": round(self.wait_total / self.checkouts * 1000, 2) if self.checkouts else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 2),
+            }
+
+
+class _MeteredQueuePool(QueuePool):
+    """Havuzdan bağlantı alma süresini ölçen QueuePool (metrics sınıf özniteliğidir,
+    dispose/recreate sonrası da korunur)."""
+    metrics: PoolMetrics
+
+    def _do_get(self):
+        t = time.monotonic()
+        try:
+            rec = super()._do_get()
+        except sa_exc.TimeoutError:
+            self.metrics.record_wait(time.monotonic() - t, ok=False)
+            raise
+        self.metrics.record_wait(time.monotonic() - t, ok=True)
+        return rec
+
+
+# application_name -> (engine, metrics)
+db_pools: dict[str, tuple] = {}
+
+
+# SQLite (gömülü/uç kurulum): DATABASE_URL=sqlite:////data/ebay.db
+# WAL okuyucuları yazarı beklemez; synchronous=NORMAL WAL'da yalnızca
+# elektrik kesintisinde son commit'leri riske atar. SQLite >= 3.39 gerekir
+# (IS [NOT] DISTINCT FROM).
+DB_BACKEND = "sqlite" if DATABASE_URL.startswith("sqlite") else "postgres"
+SQLITE_MMAP_BYTES = int(os.getenv("SQLITE_MMAP_BYTES", str(256 * 1024 * 1024)))
+SQLITE_CACHE_KIB = int(os.getenv("SQLITE_CACHE_KIB", "65536"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "30000"))
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA mmap_size={SQLITE_MMAP_BYTES}",
+    f"PRAGMA cache_size=-{SQLITE_CACHE_KIB}",
+    "PRAGMA temp_store=MEMORY",
+    f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}",
+)
+
+
+def _sqlite_on_connect(dbapi_conn, _record):
+    # İşlemleri sqlite3 modülü değil SQLAlchemy başlatsın (DDL dahil)
+    dbapi_conn.isolation_level = None
+    cur = dbapi_conn.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cur.execute(pragma)
+    cur.close()
+
+
+def _sqlite_on_begin(conn):
+    # Okuyup sonra yazan işlemler (upsert_items, önbellek) sqlite_begin="IMMEDIATE"
+    # ile yazma kilidini baştan alır: ertelenmiş BEGIN'de kilit yükseltilirken
+    # busy_timeout beklenmeden SQLITE_BUSY alınabilir. Okumalar ertelenmiş
+    # BEGIN ile başlar ve WAL'de yazarı beklemez.
+    conn.exec_driver_sql(f"BEGIN {conn.get_execution_options().get('sqlite_begin', 'DEFERRED')}")
+
+
+def make_engine(url: str, application_name: str = DB_APPLICATION_NAME, pool_size: int = DB_POOL_SIZE,
+                max_overflow: int = DB_MAX_OVERFLOW, synchronous_commit: bool = True,
+                sqlite_begin: str = "DEFERRED"):
+    """Ayarlı havuz, pre-ping ve arka uca özgü oturum ayarlarıyla engine kurar.
+
+    pool_pre_ping, Postgres yeniden başladığında bayat bağlantıları checkout
+    sırasında yakalar; pool_recycle uzun süre boşta kalanları yeniler.
+    SQLite'ta her bağlantı SQLITE_PRAGMAS ile açılır; işlemler sqlite_begin
+    kipiyle (DEFERRED/IMMEDIATE) başlar.
+    """
+    kwargs = {"echo": False, "pool_pre_ping": True, "pool_recycle": DB_POOL_RECYCLE}
+    sqlite = url.startswith("sqlite")
+    metered = url.startswith("postgresql") or (sqlite and ":memory:" not in url and url not in ("sqlite://", "sqlite:///"))
+    metrics = PoolMetrics(application_name)
+    if metered:
+        kwargs.update(
+            poolclass=type("MeteredQueuePool", (_MeteredQueuePool,), {"metrics": metrics}),
+            pool_size=pool_size, max_overflow=max_overflow, pool_timeout=DB_POOL_TIMEOUT,
+        )
+    if url.startswith("postgresql"):
+        options = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+        if not synchronous_commit:
+            options += " -c synchronous_commit=off"
+        kwargs["connect_args"] = {"application_name": application_name, "options": options}
+    elif sqlite:
+        # TIMESTAMP sütunları datetime olarak döner; Decimal parametreler metin olarak yazılır
+        sqlite3.register_adapter(Decimal, str)
+        kwargs["connect_args"] = {"detect_types": sqlite3.PARSE_DECLTYPES,
+                                  "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000, "check_same_thread": False}
+        kwargs["execution_options"] = {"sqlite_begin": sqlite_begin}
+    eng = create_engine(url, **kwargs)
+    if sqlite:
+        event.listen(eng, "connect", _sqlite_on_connect)
+        event.listen(eng, "begin", _sqlite_on_begin)
+    if metered:
+        event.listen(eng, "invalidate", lambda *a: metrics.record_invalidated())
+        db_pools[application_name] = (eng, metrics)
+    return eng
+
+
+def db_pool_stats() -> dict:
+    return {name: metrics.snapshot(eng.pool) for name, (eng, metrics) in db_pools.items()}
+
+
+engine = make_engine(DATABASE_URL)
+ingest_engine = make_engine(DATABASE_URL, f"{DB_APPLICATION_NAME}-ingest", pool_size=DB_INGEST_POOL_SIZE,
+                            synchronous_commit=not DB_INGEST_ASYNC_COMMIT, sqlite_begin="IMMEDIATE")
+
 
 # ------------------- DB yapısı -------------------
-DDL = """
-CREATE TABLE IF NOT EXISTS public.ebay_items (
+# Sıralı şema göçleri: (sürüm, açıklama, SQL). Uygulanan sürümler
+# schema_version tablosunda tutulur; yeni değişiklik listenin sonuna yeni
+# sürümle eklenir, uygulanmış bir göç asla düzenlenmez. İlk sürümler eski
+# ensure_schema DDL'inin bölünmüş halidir ve IF NOT EXISTS ile mevcut
+# veritabanlarında zararsızca çalışır.
+MIGRATIONS = [
+    (1, "ebay_items", """
+CREATE TABLE IF NOT EXISTS ebay_items (
   item_id TEXT PRIMARY KEY,
   title TEXT,
   price_value NUMERIC,
@@ -73,18 +361,195 @@ CREATE TABLE IF NOT EXISTS public.ebay_items (
   last_seen_utc TIMESTAMP,
   ai_price_estimate NUMERIC
 );
-"""
+ALTER TABLE ebay_items ADD COLUMN IF NOT EXISTS content_hash TEXT;
+"""),
+    (2, "fiyat geçmişi (aylık bölümlü, yalnızca fiyat değişince yazılır)", """
+CREATE TABLE IF NOT EXISTS ebay_price_history (
+  item_id TEXT NOT NULL,
+  observed_at TIMESTAMP NOT NULL,
+  price_value NUMERIC,
+  currency TEXT
+) PARTITION BY RANGE (observed_at);
+CREATE INDEX IF NOT EXISTS ebay_price_history_item_idx
+  ON ebay_price_history (item_id, observed_at);
+"""),
+    (3, "Gemini tahmin önbelleği", """
+CREATE TABLE IF NOT EXISTS ai_prediction_cache (
+  fingerprint TEXT PRIMARY KEY,
+  estimate NUMERIC NOT NULL,
+  model TEXT,
+  created_at TIMESTAMP NOT NULL,
+  last_hit_at TIMESTAMP NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ai_prediction_cache_last_hit_idx
+  ON ai_prediction_cache (last_hit_at);
+"""),
+    (4, "gönderilmiş fiyat uyarıları", """
+CREATE TABLE IF NOT EXISTS telegram_alerts (
+  item_id TEXT PRIMARY KEY,
+  alerted_price NUMERIC,
+  alerted_at TIMESTAMP NOT NULL
+);
+"""),
+    (5, "sorgu başına yoklama aralığı ve filigran", """
+CREATE TABLE IF NOT EXISTS ebay_query_state (
+  query_key TEXT PRIMARY KEY,
+  interval_seconds INTEGER NOT NULL,
+  next_run_utc TIMESTAMP NOT NULL,
+  last_run_utc TIMESTAMP,
+  last_churn INTEGER,
+  churn_ewma DOUBLE PRECISION NOT NULL DEFAULT 0
+);
+ALTER TABLE ebay_query_state ADD COLUMN IF NOT EXISTS watermark_utc TIMESTAMP;
+"""),
+    (6, "piyasa istatistiği sütunları", """
+ALTER TABLE ebay_items ADD COLUMN IF NOT EXISTS market_median NUMERIC;
+ALTER TABLE ebay_items ADD COLUMN IF NOT EXISTS deal_score DOUBLE PRECISION;
+"""),
+    (7, "ürün kümeleri (MinHash imzası) ve LSH kovaları", """
+ALTER TABLE ebay_items ADD COLUMN IF NOT EXISTS product_cluster_id TEXT;
+CREATE INDEX IF NOT EXISTS ebay_items_cluster_idx ON ebay_items (product_cluster_id);
+CREATE TABLE IF NOT EXISTS product_clusters (
+  cluster_id TEXT PRIMARY KEY,
+  signature BYTEA NOT NULL,
+  model_numbers TEXT,
+  title TEXT,
+  created_at TIMESTAMP NOT NULL
+);
+CREATE TABLE IF NOT EXISTS product_cluster_lsh (
+  band INTEGER NOT NULL,
+  bucket TEXT NOT NULL,
+  cluster_id TEXT NOT NULL,
+  PRIMARY KEY (band, bucket, cluster_id)
+);
+CREATE INDEX IF NOT EXISTS product_cluster_lsh_bucket_idx ON product_cluster_lsh (bucket);
+"""),
+    (8, "okuma yolu indeksleri (tahmin birikmiş işi, kategori, satıcı)", """
+CREATE INDEX IF NOT EXISTS ebay_items_unpriced_recent_idx ON ebay_items (last_seen_utc DESC)
+  WHERE ai_price_estimate IS NULL AND deal_score IS NULL;
+CREATE INDEX IF NOT EXISTS ebay_items_category_seen_idx ON ebay_items (category_id, last_seen_utc);
+CREATE INDEX IF NOT EXISTS ebay_items_seller_idx ON ebay_items (seller_username);
+"""),
+    (9, "fiyat geçmişi varsayılan bölümü (aylık bölüm oluşturulamazsa)", """
+CREATE TABLE IF NOT EXISTS ebay_price_history_default
+  PARTITION OF ebay_price_history DEFAULT;
+"""),
+    (10, "gönderilemeyen Telegram uyarıları", """
+CREATE TABLE IF NOT EXISTS telegram_alert_outbox (
+  item_id TEXT PRIMARY KEY,
+  queued_at TIMESTAMP NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0
+);
+"""),
+]
+
+# Aynı sürümlerin SQLite karşılıkları: ADD COLUMN IF NOT EXISTS ve bölümleme
+# yok; fiyat geçmişi tek tablodur (saklama süresi DELETE ile uygulanır).
+SQLITE_MIGRATIONS = [
+    (1, "ebay_items", """
+CREATE TABLE IF NOT EXISTS ebay_items (
+  item_id TEXT PRIMARY KEY,
+  title TEXT,
+  price_value NUMERIC,
+  price_currency TEXT,
+  item_href TEXT,
+  seller_username TEXT,
+  condition_display_name TEXT,
+  category_id TEXT,
+  category_name TEXT,
+  brand TEXT,
+  last_seen_utc TIMESTAMP,
+  ai_price_estimate NUMERIC,
+  content_hash TEXT
+);
+"""),
+    (2, "fiyat geçmişi", """
+CREATE TABLE IF NOT EXISTS ebay_price_history (
+  item_id TEXT NOT NULL,
+  observed_at TIMESTAMP NOT NULL,
+  price_value NUMERIC,
+  currency TEXT
+);
+CREATE INDEX IF NOT EXISTS ebay_price_history_item_idx
+  ON ebay_price_history (item_id, observed_at);
+CREATE INDEX IF NOT EXISTS ebay_price_history_observed_idx
+  ON ebay_price_history (observed_at);
+"""),
+    (3, "Gemini tahmin önbelleği", MIGRATIONS[2][2]),
+    (4, "gönderilmiş fiyat uyarıları", MIGRATIONS[3][2]),
+    (5, "sorgu başına yoklama aralığı ve filigran", """
+CREATE TABLE IF NOT EXISTS ebay_query_state (
+  query_key TEXT PRIMARY KEY,
+  interval_seconds INTEGER NOT NULL,
+  next_run_utc TIMESTAMP NOT NULL,
+  last_run_utc TIMESTAMP,
+  last_churn INTEGER,
+  churn_ewma DOUBLE PRECISION NOT NULL DEFAULT 0,
+  watermark_utc TIMESTAMP
+);
+"""),
+    (6, "piyasa istatistiği sütunları", """
+ALTER TABLE ebay_items ADD COLUMN market_median NUMERIC;
+ALTER TABLE ebay_items ADD COLUMN deal_score DOUBLE PRECISION;
+"""),
+    (7, "ürün kümeleri (MinHash imzası) ve LSH kovaları", """
+ALTER TABLE ebay_items ADD COLUMN product_cluster_id TEXT;
+CREATE INDEX IF NOT EXISTS ebay_items_cluster_idx ON ebay_items (product_cluster_id);
+CREATE TABLE IF NOT EXISTS product_clusters (
+  cluster_id TEXT PRIMARY KEY,
+  signature BLOB NOT NULL,
+  model_numbers TEXT,
+  title TEXT,
+  created_at TIMESTAMP NOT NULL
+);
+CREATE TABLE IF NOT EXISTS product_cluster_lsh (
+  band INTEGER NOT NULL,
+  bucket TEXT NOT NULL,
+  cluster_id TEXT NOT NULL,
+  PRIMARY KEY (band, bucket, cluster_id)
+);
+CREATE INDEX IF NOT EXISTS product_cluster_lsh_bucket_idx ON product_cluster_lsh (bucket);
+"""),
+    (8, "okuma yolu indeksleri (tahmin birikmiş işi, kategori, satıcı)", """
+CREATE INDEX IF NOT EXISTS ebay_items_unpriced_recent_idx ON ebay_items (last_seen_utc DESC)
+  WHERE ai_price_estimate IS NULL AND deal_score IS NULL;
+CREATE INDEX IF NOT EXISTS ebay_items_category_seen_idx ON ebay_items (category_id, last_seen_utc);
+CREATE INDEX IF NOT EXISTS ebay_items_seller_idx ON ebay_items (seller_username);
+"""),
+    (9, "fiyat geçmişi varsayılan bölümü (SQLite'ta bölümleme yok)", ""),
+    (10, "gönderilemeyen Telegram uyarıları", """
+CREATE TABLE IF NOT EXISTS telegram_alert_outbox (
+  item_id TEXT PRIMARY KEY,
+  queued_at TIMESTAMP NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0
+);
+"""),
+]
 
-UPSERT_SQL = """
-INSERT INTO public.ebay_items (
-  item_id, title, price_value, price_currency, item_href, seller_username,
-  condition_display_name, category_id, category_name, brand, last_seen_utc,
-  ai_price_estimate
-) VALUES (
-  :item_id, :title, :price_value, :price_currency, :item_href, :seller_username,
-  :condition_display_name, :category_id, :category_name, :brand, :last_seen_utc,
-  :ai_price_estimate
+SCHEMA_VERSION_DDL = """
+CREATE TABLE IF NOT EXISTS schema_version (
+  version INTEGER PRIMARY KEY,
+  description TEXT,
+  applied_at TIMESTAMP NOT NULL
 )
+"""
+# pg_advisory_lock anahtarı: aynı anda açılan worker'lar göçü sırayla görür
+SCHEMA_MIGRATION_LOCK_ID = 0x65426179  # "eBay"
+
+UPSERT_COLUMNS = [
+    "item_id", "title", "price_value", "price_currency", "item_href", "seller_username",
+    "condition_display_name", "category_id", "category_name", "brand", "last_seen_utc",
+    "content_hash", "product_cluster_id",
+]
+
+# Fiyatı etkileyen alanlardan biri değişti mi (tahminler bu durumda silinir)
+PRICE_INPUTS_CHANGED_SQL = """
+    ebay_items.title IS DISTINCT FROM EXCLUDED.title
+      OR ebay_items.condition_display_name IS DISTINCT FROM EXCLUDED.condition_display_name
+      OR ebay_items.price_value IS DISTINCT FROM EXCLUDED.price_value
+"""
+
+UPSERT_CONFLICT_SQL = f"""
 ON CONFLICT (item_id) DO UPDATE SET
   title = EXCLUDED.title,
   price_value = EXCLUDED.price_value,
@@ -96,30 +561,334 @@ ON CONFLICT (item_id) DO UPDATE SET
   category_name = EXCLUDED.category_name,
   brand = EXCLUDED.brand,
   last_seen_utc = EXCLUDED.last_seen_utc,
-  ai_price_estimate = EXCLUDED.ai_price_estimate;
+  content_hash = EXCLUDED.content_hash,
+  product_cluster_id = COALESCE(EXCLUDED.product_cluster_id, ebay_items.product_cluster_id),
+  -- Tahminler yalnızca fiyatı etkileyen alanlar değişince silinir
+  ai_price_estimate = CASE WHEN {PRICE_INPUTS_CHANGED_SQL} THEN NULL ELSE ebay_items.ai_price_estimate END,
+  market_median = CASE WHEN {PRICE_INPUTS_CHANGED_SQL} THEN NULL ELSE ebay_items.market_median END,
+  deal_score = CASE WHEN {PRICE_INPUTS_CHANGED_SQL} THEN NULL ELSE ebay_items.deal_score END
+-- Daha eski bir gözlem (ör. eski bir kaydın tekrar oynatılması) güncel satırı ezmez
+WHERE ebay_items.last_seen_utc IS NULL OR ebay_items.last_seen_utc <= EXCLUDED.last_seen_utc
+"""
+
+# Zenginleştirme (AI) yalnızca kendi sütununu yazar; tahmin sırasında ürün
+# değiştiyse (hash farklıysa) eski tahmin yazılmaz
+ENRICH_SQL = """
+UPDATE ebay_items SET ai_price_estimate = :ai_price_estimate
+WHERE item_id = :item_id AND content_hash IS NOT DISTINCT FROM :content_hash
+"""
+
+UPSERT_SQL = f"""
+INSERT INTO ebay_items ({", ".join(UPSERT_COLUMNS)})
+VALUES ({", ".join(":" + c for c in UPSERT_COLUMNS)})
+{UPSERT_CONFLICT_SQL};
 """
 
+# Toplu yazım: psycopg2 execute_values tek ifadede çok satır gönderir,
+# büyük partilerde COPY ile geçici tabloya yükleyip tek INSERT ... SELECT yapılır.
+UPSERT_VALUES_SQL = f"""
+INSERT INTO ebay_items ({", ".join(UPSERT_COLUMNS)}) VALUES %s
+{UPSERT_CONFLICT_SQL}
+"""
+
+UPSERT_FROM_STAGE_SQL = f"""
+INSERT INTO ebay_items ({", ".join(UPSERT_COLUMNS)})
+SELECT {", ".join(UPSERT_COLUMNS)} FROM ebay_items_stage
+{UPSERT_CONFLICT_SQL}
+"""
+
+BULK_COPY_THRESHOLD = int(os.getenv("BULK_COPY_THRESHOLD", "5000"))
+BULK_PAGE_SIZE = int(os.getenv("BULK_PAGE_SIZE", "1000"))
+
+# İçeriği değişmeyen satırlar bu süre içinde hiç yazılmaz; süre geçtiyse
+# yalnızca last_seen_utc güncellenir (saniye)
+INGEST_FRESHNESS_SECONDS = int(os.getenv("INGEST_FRESHNESS_SECONDS", "3600"))
+HASHED_COLUMNS = [
+    "title", "price_value", "price_currency", "seller_username",
+    "condition_display_name", "category_id", "brand",
+]
+
+EXISTING_ROWS_SQL = text("""
+SELECT item_id, content_hash, last_seen_utc, price_value, price_currency
+FROM ebay_items WHERE item_id IN :ids
+""").bindparams(bindparam("ids", expanding=True))
+
+TOUCH_SQL = """
+UPDATE ebay_items SET last_seen_utc = :last_seen_utc WHERE item_id = :item_id
+"""
+
+TOUCH_VALUES_SQL = """
+UPDATE ebay_items AS e SET last_seen_utc = v.last_seen_utc
+FROM (VALUES %s) AS v (item_id, last_seen_utc)
+WHERE e.item_id = v.item_id
+"""
+
+PRICE_HISTORY_SQL = """
+INSERT INTO ebay_price_history (item_id, observed_at, price_value, currency)
+VALUES (:item_id, :observed_at, :price_value, :currency)
+"""
+
+# Tekrar oynatmada aynı gözlem iki kez yazılmasın
+EXISTING_HISTORY_SQL = text("""
+SELECT item_id, observed_at FROM ebay_price_history WHERE item_id IN :ids
+""").bindparams(bindparam("ids", expanding=True))
+
+PRICE_HISTORY_VALUES_SQL = """
+INSERT INTO ebay_price_history (item_id, observed_at, price_value, currency) VALUES %s
+"""
+
+PRICE_HISTORY_RETENTION_MONTHS = int(os.getenv("PRICE_HISTORY_RETENTION_MONTHS", "12"))
+
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def migrate_schema(conn) -> list[int]:
+    """Uygulanmamış göçleri sırayla, her birini kendi işleminde uygular.
+
+    Postgres'te oturum düzeyinde advisory lock alınır; aynı anda başlayan
+    diğer worker'lar kilidi bekler, sonra güncel sürümü görüp DDL
+    çalıştırmaz. Kilit beklemesi ve uzun CREATE INDEX'ler havuzun
+    statement_timeout'una takılmasın diye bu oturumda zaman aşımı kapatılır.
+    SQLite tek süreçlidir, kilit alınmaz.
+    Dönüş: bu çağrıda uygulanan sürümler.
+    """
+    sqlite = conn.dialect.name == "sqlite"
+    migrations = SQLITE_MIGRATIONS if sqlite else MIGRATIONS
+    applied = []
+    if not sqlite:
+        conn.execute(text("SET statement_timeout = 0"))
+        conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": SCHEMA_MIGRATION_LOCK_ID})
+        conn.commit()
+    try:
+        with conn.begin():
+            conn.execute(text(SCHEMA_VERSION_DDL))
+            current = conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_version")).scalar()
+        for version, description, sql in migrations:
+            if version <= current:
+                continue
+            with conn.begin():
+                # sqlite3 tek çağrıda tek ifade çalıştırır
+                for stmt in (sql.split(";") if sqlite else [sql]):
+                    if stmt.strip():
+                        conn.execute(text(stmt))
+                conn.execute(text("""
+                    INSERT INTO schema_version (version, description, applied_at)
+                    VALUES (:v, :d, :t)
+                """), {"v": version, "d": description, "t": _utcnow()})
+            print(f"[Schema] göç {version} uygulandı: {description}", flush=True)
+            applied.append(version)
+    finally:
+        if not sqlite:
+            conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": SCHEMA_MIGRATION_LOCK_ID})
+            # Bağlantı havuza bağlantı seçeneklerindeki zaman aşımıyla döner
+            conn.execute(text("RESET statement_timeout"))
+            conn.commit()
+    return applied
+
+
 def ensure_schema():
-    with engine.begin() as conn:
-        conn.execute(text(DDL))
+    """Şema göçlerini süreç başına bir kez çalıştırır; sonraki çağrılar hiçbir şey yapmaz."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        with engine.connect() as conn:
+            applied = migrate_schema(conn)
+        if not applied:
+            print(f"[Schema] güncel (sürüm {MIGRATIONS[-1][0]})", flush=True)
+        _schema_ready = True
 
 
 # ------------------- eBay API -------------------
-def get_access_token() -> str:
-    url = "https://api.ebay.com/identity/v1/oauth2/token"
+INGEST_MAX_IN_FLIGHT = int(os.getenv("INGEST_MAX_IN_FLIGHT", "4"))
+EBAY_RATE_PER_SEC = float(os.getenv("EBAY_RATE_PER_SEC", "2"))
+EBAY_RATE_BURST = int(os.getenv("EBAY_RATE_BURST", "4"))
+ebay_rate_limiter = TokenBucket(EBAY_RATE_PER_SEC, EBAY_RATE_BURST)
+EBAY_SEARCH_URL = "https://api.ebay.com/buy/browse/v1/item_summary/search"
+EBAY_PAGE_SIZE_MAX = 200
+EBAY_MAX_PAGES = int(os.getenv("EBAY_MAX_PAGES", "10"))
+# Artımlı mod: yalnızca son yoklamadan sonra listelenen ürünleri getir.
+# Sorguda "incremental": true/false ile sorgu bazında da seçilebilir.
+INGEST_INCREMENTAL = os.getenv("INGEST_INCREMENTAL", "0") == "1"
+# Geç indekslenen ilanları kaçırmamak için filigrandan geriye bu kadar bakılır (saniye)
+INGEST_WATERMARK_OVERLAP_SECONDS = int(os.getenv("INGEST_WATERMARK_OVERLAP_SECONDS", "600"))
+# Filigrandan sonraki tüm yeni ilanlar getirilir (limit/max_pages uygulanmaz);
+# bu yalnızca kaçak bir sorguyu durduran güvenlik sınırıdır
+INGEST_INCREMENTAL_MAX_PAGES = int(os.getenv("INGEST_INCREMENTAL_MAX_PAGES", "50"))
+# eBay'e gönderilmeyen, yalnızca bu uygulamanın kullandığı sorgu anahtarları
+QUERY_CONTROL_KEYS = ("max_pages", "max_items", "incremental")
+
+
+def _is_incremental(query: dict) -> bool:
+    return bool(query.get("incremental", INGEST_INCREMENTAL))
+
+
+# Arama yanıtı çözümleme: auto | orjson | ijson | json.
+# orjson tüm belgeyi hızlı çözer; ijson belgeyi akış olarak okuyup yalnızca
+# flatten_item'in kullandığı alanları kurar (resimler, kargo seçenekleri vb. atlanır).
+EBAY_JSON_PARSER = os.getenv("EBAY_JSON_PARSER", "auto").lower()
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ijson
+except ImportError:
+    ijson = None
+if EBAY_JSON_PARSER in ("orjson", "ijson") and {"orjson": orjson, "ijson": ijson}[EBAY_JSON_PARSER] is None:
+    print(f"Uyarı: EBAY_JSON_PARSER={EBAY_JSON_PARSER} ama paket kurulu değil; json kullanılacak.", flush=True)
+
+ITEM_FIELDS = frozenset({
+    "itemId", "title", "price", "itemHref", "seller", "conditionDisplayName", "condition",
+    "categories", "brand", "itemCreationDate",
+})
+
+
+def json_loads(data: bytes | str):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def _project_item(it: dict) -> dict:
+    return {k: v for k, v in it.items() if k in ITEM_FIELDS}
+
+
+def _parse_search_stream(content: bytes) -> dict:
+    """ijson olaylarından {"itemSummaries": [...], "next": ..., "total": ...} kurar."""
+    items, body = [], {}
+    cur, field, builder = None, None, None
+    for prefix, event, value in ijson.parse(io.BytesIO(content)):
+        if prefix == "itemSummaries.item":
+            if builder is not None:
+                cur[field] = builder.value
+                builder = None
+            if event == "start_map":
+                cur = {}
+            elif event == "end_map":
+                items.append(cur)
+            elif event == "map_key" and value in ITEM_FIELDS:
+                field, builder = value, ijson.ObjectBuilder()
+        elif builder is not None and prefix.startswith("itemSummaries.item."):
+            builder.event(event, value)
+        elif prefix in ("next", "total") and event in ("string", "number"):
+            body[prefix] = value
+    body["itemSummaries"] = items
+    return body
+
+
+def parse_search_page(content: bytes) -> dict:
+    """Arama yanıtını çözer; ürünler yalnızca ITEM_FIELDS alanlarını taşır."""
+    parser = EBAY_JSON_PARSER
+    if parser == "auto":
+        parser = "orjson" if orjson is not None else "ijson" if ijson is not None else "json"
+    if parser == "ijson" and ijson is not None:
+        return _parse_search_stream(content)
+    body = orjson.loads(content) if parser == "orjson" and orjson is not None else json.loads(content)
+    body["itemSummaries"] = [_project_item(it) for it in body.get("itemSummaries") or []]
+    return body
+
+EBAY_TOKEN_URL = "https://api.ebay.com/identity/v1/oauth2/token"
+EBAY_TOKEN_CACHE_PATH = os.getenv("EBAY_TOKEN_CACHE_PATH", ".ebay_token.json")
+EBAY_TOKEN_REFRESH_MARGIN = int(os.getenv("EBAY_TOKEN_REFRESH_MARGIN", "300"))  # saniye
+
+
+def _request_new_token() -> tuple[str, float]:
+    """eBay'den yeni bir client-credentials token alır; (token, bitiş zamanı) döner."""
     data = {"grant_type": "client_credentials", "scope": "https://api.ebay.com/oauth/api_scope"}
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    r = requests.post(url, data=data, auth=(EBAY_CLIENT_ID, EBAY_CLIENT_SECRET), headers=headers, timeout=30)
+    r = http_client.post(EBAY_TOKEN_URL, data=data, auth=(EBAY_CLIENT_ID, EBAY_CLIENT_SECRET), headers=headers)
     r.raise_for_status()
-    return r.json()["access_token"]
+    body = r.json()
+    return body["access_token"], time.time() + int(body.get("expires_in", 7200))
+
+
+class EbayTokenManager:
+    """Token'ı bellekte ve diskte tutar, süresi dolmadan arka planda yeniler.
+
+    Disk önbelleği sayesinde yeniden başlayan süreçler ve diğer işler
+    geçerli token'ı tekrar kullanır; her çalıştırmada yeni token alınmaz.
+    """
+
+    def __init__(self, cache_path: str, margin: int):
+        self.cache_path = cache_path
+        self.margin = margin
+        self._lock = threading.Lock()
+        self._token: str | None = None
+        self._expires_at = 0.0
+        self._timer: threading.Timer | None = None
+
+    def _fresh(self) -> bool:
+        return bool(self._token) and time.time() < self._expires_at - self.margin
 
-def flatten_item(it: dict) -> dict:
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            self._token = cached["access_token"]
+            self._expires_at = float(cached["expires_at"])
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _save_cache(self):
+        tmp = self.cache_path + ".tmp"
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"access_token": self._token, "expires_at": self._expires_at}, f)
+            os.replace(tmp, self.cache_path)
+        except OSError as e:
+            print(f"[Token] önbellek yazılamadı: {e}", flush=True)
+
+    def _schedule_refresh(self):
+        if self._timer:
+            self._timer.cancel()
+        delay = max(self._expires_at - self.margin - time.time(), 1)
+        self._timer = threading.Timer(delay, self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        try:
+            self.get(force=True)
+            print("[Token] arka planda yenilendi", flush=True)
+        except Exception as e:
+            print(f"[Token] yenileme hatası: {e}", flush=True)
+            self._timer = threading.Timer(60, self._background_refresh)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def get(self, force: bool = False) -> str:
+        """Geçerli token'ı döner; force=True ise (örn. 401 sonrası) yenisini alır."""
+        with self._lock:
+            if not force:
+                if self._fresh():
+                    return self._token
+                self._load_cache()
+                if self._fresh():
+                    self._schedule_refresh()
+                    return self._token
+            self._token, self._expires_at = _request_new_token()
+            self._save_cache()
+            self._schedule_refresh()
+            return self._token
+
+
+token_manager = EbayTokenManager(EBAY_TOKEN_CACHE_PATH, EBAY_TOKEN_REFRESH_MARGIN)
+
+
+def get_access_token() -> str:
+    return token_manager.get()
+
+def flatten_item(it: dict, seen_at: datetime | None = None) -> dict:
     price = it.get("price") or {}
     seller = it.get("seller") or {}
     cats = it.get("categories") or []
     first_c = cats[0] if cats else {}
     cond = it.get("conditionDisplayName") or it.get("condition")
-    return {
+    row = {
         "item_id": it.get("itemId"),
         "title": it.get("title"),
         "price_value": (price.get("value") if isinstance(price, dict) else None),
@@ -130,154 +899,1869 @@ def flatten_item(it: dict) -> dict:
         "category_id": first_c.get("categoryId"),
         "category_name": first_c.get("categoryName"),
         "brand": it.get("brand"),
-        "last_seen_utc": datetime.now(timezone.utc).replace(tzinfo=None),
-        "ai_price_estimate": None,
+        "last_seen_utc": seen_at or _utcnow(),
     }
+    row["content_hash"] = _content_hash(row)
+    return row
+
+def _content_hash(row: dict) -> str:
+    raw = "\x1f".join("" if row.get(c) is None else str(row.get(c)) for c in HASHED_COLUMNS)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def _copy_field(v) -> str:
+    """COPY text formatı için değer kaçışı (NULL -> \\N)."""
+    if v is None:
+        return "\\N"
+    return (str(v).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def _upsert_rowwise(conn, rows: list[dict]):
+    # Eski yol: satır başına bir istek (yalnızca karşılaştırma için)
+    for r in rows:
+        conn.execute(text(UPSERT_SQL), r)
+
 
-def upsert_items(rows: list[dict]):
+def _upsert_executemany(conn, rows: list[dict]):
+    conn.execute(text(UPSERT_SQL), rows)
+
+
+def _upsert_values(conn, rows: list[dict]):
+    from psycopg2.extras import execute_values
+    cur = conn.connection.cursor()
+    execute_values(cur, UPSERT_VALUES_SQL,
+                   [tuple(r.get(c) for c in UPSERT_COLUMNS) for r in rows],
+                   page_size=BULK_PAGE_SIZE)
+
+
+def _upsert_copy(conn, rows: list[dict]):
+    cur = conn.connection.cursor()
+    cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS ebay_items_stage
+        (LIKE ebay_items INCLUDING DEFAULTS) ON COMMIT DROP
+    """)
+    buf = io.StringIO()
+    for r in rows:
+        buf.write("\t".join(_copy_field(r.get(c)) for c in UPSERT_COLUMNS))
+        buf.write("\n")
+    buf.seek(0)
+    cur.copy_expert(f"COPY ebay_items_stage ({', '.join(UPSERT_COLUMNS)}) FROM STDIN", buf)
+    cur.execute(UPSERT_FROM_STAGE_SQL)
+
+
+def _touch_rows(conn, rows: list[dict]):
+    if engine.dialect.driver != "psycopg2":
+        conn.execute(text(TOUCH_SQL), [{"item_id": r["item_id"], "last_seen_utc": r["last_seen_utc"]} for r in rows])
+        return
+    from psycopg2.extras import execute_values
+    cur = conn.connection.cursor()
+    execute_values(cur, TOUCH_VALUES_SQL, [(r["item_id"], r["last_seen_utc"]) for r in rows],
+                   template="(%s, %s::timestamp)", page_size=BULK_PAGE_SIZE)
+
+
+def _month_start(ts: datetime) -> datetime:
+    return ts.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+_history_partitions: set[datetime] = set()
+_history_partitions_lock = threading.Lock()
+# Oluşturulamayan ay -> yeniden denenebileceği an (monotonic); her partide DDL denenmesin
+_history_partition_retry_at: dict[datetime, float] = {}
+HISTORY_PARTITION_RETRY_SECONDS = float(os.getenv("HISTORY_PARTITION_RETRY_SECONDS", "600"))
+
+
+def _create_history_partition(month: datetime, move_default: bool = False):
+    """Ayın bölümünü kendi kısa işleminde oluşturur ve commit eder.
+
+    Ingest işleminin içinde yapılmaz: işlem geri alınırsa bölüm de gider,
+    ayrıca DDL üst tabloda işlem boyunca ACCESS EXCLUSIVE kilit tutar.
+    Varsayılan bölümde o aya ait satır varsa Postgres bölümü oluşturmaz;
+    move_default=True ise (bakım işi) aynı işlemde varsayılan bölüm ayrılır,
+    bölüm oluşturulur, satırlar taşınır ve varsayılan bölüm geri bağlanır.
+    """
+    nxt = _month_start(month + timedelta(days=32))
+    name = f"ebay_price_history_{month:%Y%m}"
+    bounds = {"lo": month, "hi": nxt}
+    create = f"""
+        CREATE TABLE IF NOT EXISTS {name}
+        PARTITION OF ebay_price_history
+        FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{nxt:%Y-%m-%d}')
+    """
+    with engine.begin() as conn:
+        stranded = move_default and conn.execute(text("""
+            SELECT EXISTS (SELECT 1 FROM ebay_price_history_default WHERE observed_at >= :lo AND observed_at < :hi)
+        """), bounds).scalar()
+        if not stranded:
+            conn.execute(text(create))
+            return
+        conn.execute(text("ALTER TABLE ebay_price_history DETACH PARTITION ebay_price_history_default"))
+        conn.execute(text(create))
+        n = conn.execute(text(f"""
+            INSERT INTO {name} (item_id, observed_at, price_value, currency)
+            SELECT item_id, observed_at, price_value, currency FROM ebay_price_history_default
+            WHERE observed_at >= :lo AND observed_at < :hi
+        """), bounds).rowcount
+        conn.execute(text("DELETE FROM ebay_price_history_default WHERE observed_at >= :lo AND observed_at < :hi"),
+                     bounds)
+        conn.execute(text("ALTER TABLE ebay_price_history ATTACH PARTITION ebay_price_history_default DEFAULT"))
+    print(f"[History] {name} oluşturuldu, varsayılan bölümden {n} satır taşındı", flush=True)
+
+
+def _ensure_history_partitions(months: set[datetime]):
+    """Eksik aylık bölümleri oluşturur; ay yalnızca commit'ten sonra önbelleklenir.
+
+    Oluşturma başarısız olursa satırlar varsayılan bölüme düşer; ay
+    HISTORY_PARTITION_RETRY_SECONDS sonra yeniden denenir, varsayılan bölüme
+    düşen satırları günlük bakım işi yeni bölüme taşır.
+    """
+    with _history_partitions_lock:
+        now = time.monotonic()
+        for month in sorted(months - _history_partitions):
+            if _history_partition_retry_at.get(month, 0) > now:
+                continue
+            try:
+                _create_history_partition(month)
+            except Exception as e:
+                _history_partition_retry_at[month] = now + HISTORY_PARTITION_RETRY_SECONDS
+                print(f"[History] bölüm oluşturulamadı ({month:%Y-%m}), varsayılan bölüm kullanılacak: {e}",
+                      flush=True)
+                continue
+            _history_partition_retry_at.pop(month, None)
+            _history_partitions.add(month)
+
+
+def _insert_price_history(conn, rows: list[dict]):
+    params = [(r["item_id"], r["last_seen_utc"], r["price_value"], r["price_currency"]) for r in rows]
+    if engine.dialect.driver != "psycopg2":
+        keys = ("item_id", "observed_at", "price_value", "currency")
+        conn.execute(text(PRICE_HISTORY_SQL), [dict(zip(keys, p)) for p in params])
+        return
+    from psycopg2.extras import execute_values
+    cur = conn.connection.cursor()
+    execute_values(cur, PRICE_HISTORY_VALUES_SQL, params, page_size=BULK_PAGE_SIZE)
+
+
+def _price_changed(old, r: dict) -> bool:
+    if old.price_currency != r["price_currency"]:
+        return True
+    if old.price_value is None or r["price_value"] is None:
+        return old.price_value is not r["price_value"]
+    try:
+        return Decimal(str(old.price_value)) != Decimal(str(r["price_value"]))
+    except InvalidOperation:
+        return True
+
+
+def _classify_rows(conn, rows: list[dict]) -> tuple[list[dict], list[dict], list[dict], Counter]:
+    """Satırları mevcut kayıtlarla karşılaştırır.
+
+    Dönüş: (tam yazılacaklar, yalnızca dokunulacaklar, fiyatı değişenler, sayaçlar).
+    """
+    existing = {}
+    for i in range(0, len(rows), BULK_COPY_THRESHOLD):
+        ids = [r["item_id"] for r in rows[i:i + BULK_COPY_THRESHOLD]]
+        for e in conn.execute(EXISTING_ROWS_SQL, {"ids": ids}):
+            existing[e.item_id] = e
+
+    stats = Counter()
+    write, touch, priced = [], [], []
+    for r in rows:
+        old = existing.get(r["item_id"])
+        if old is not None and old.last_seen_utc is not None and r["last_seen_utc"] < old.last_seen_utc:
+            # Kayıtlı satırdan eski gözlem (tekrar oynatma): güncel satır ezilmez
+            stats["stale"] += 1
+        elif old is None:
+            stats["inserted"] += 1
+            write.append(r)
+            priced.append(r)
+        elif old.content_hash != r["content_hash"]:
+            stats["changed"] += 1
+            write.append(r)
+            if _price_changed(old, r):
+                priced.append(r)
+        elif (old.last_seen_utc is None or
+              (r["last_seen_utc"] - old.last_seen_utc).total_seconds() >= INGEST_FRESHNESS_SECONDS):
+            stats["touched"] += 1
+            touch.append(r)
+        else:
+            stats["skipped"] += 1
+    stats["priced"] = len(priced)
+    return write, touch, priced, stats
+
+
+def _new_observations(conn, history: list[dict]) -> list[dict]:
+    """Gözlemlerden (item_id, last_seen_utc) çifti fiyat geçmişinde olmayanlar, tekrarsız."""
+    ids = sorted({r["item_id"] for r in history})
+    known = set()
+    for i in range(0, len(ids), BULK_COPY_THRESHOLD):
+        known.update(tuple(e) for e in conn.execute(EXISTING_HISTORY_SQL, {"ids": ids[i:i + BULK_COPY_THRESHOLD]}))
+    fresh = {}
+    for r in history:
+        key = (r["item_id"], r["last_seen_utc"])
+        if key not in known:
+            fresh.setdefault(key, r)
+    return list(fresh.values())
+
+
+def upsert_items(rows: list[dict], changed_ids: set[str] | None = None,
+                 history: list[dict] | None = None) -> Counter:
+    """Partiyi tek seferde yazar; yöntem sürücüye ve parti boyutuna göre seçilir.
+
+    İçerik hash'i değişmeyen satırlar yeniden yazılmaz (bkz. INGEST_FRESHNESS_SECONDS),
+    kayıtlı satırdan eski gözlemler ebay_items'a hiç yazılmaz (stale).
+    changed_ids verilirse yeni/değişen ürünlerin item_id'leri buna eklenir.
+    history verilirse (tekrar oynatma) fiyat geçmişine yalnızca fiyatı
+    değişenler değil, henüz kayıtlı olmayan tüm gözlemler yazılır.
+    Dönüş: inserted / changed / touched / skipped / stale sayaçları.
+    """
     if not rows:
+        return Counter()
+    # Aynı item_id iki kez gelirse ON CONFLICT hata verir: sonuncusu kalsın
+    rows = list({r["item_id"]: r for r in rows}.values())
+    for r in rows:
+        if not r.get("content_hash"):
+            r["content_hash"] = _content_hash(r)
+    if DB_BACKEND == "postgres":
+        # Bölümler ingest işleminden önce, ayrı işlemde hazırlanır
+        _ensure_history_partitions({_month_start(r["last_seen_utc"]) for r in rows + (history or [])})
+    with ingest_engine.begin() as conn:
+        write, touch, priced, stats = _classify_rows(conn, rows)
+        if history is not None:
+            priced = _new_observations(conn, history)
+            stats["priced"] = len(priced)
+        if changed_ids is not None:
+            changed_ids.update(r["item_id"] for r in write)
+        if touch:
+            _touch_rows(conn, touch)
+        if priced:
+            _insert_price_history(conn, priced)
+        if write:
+            assign_product_clusters(conn, write)
+            if engine.dialect.driver != "psycopg2":
+                _upsert_executemany(conn, write)
+            elif len(write) >= BULK_COPY_THRESHOLD:
+                _upsert_copy(conn, write)
+            else:
+                _upsert_values(conn, write)
+    return stats
+
+
+def update_price_estimates(rows: list[dict]):
+    """AI tahminlerini yazar; ingest sütunlarına dokunmaz."""
+    params = [{"item_id": r["item_id"], "ai_price_estimate": r["ai_price_estimate"],
+               "content_hash": r.get("content_hash")}
+              for r in rows if r.get("ai_price_estimate") is not None]
+    if not params:
         return
     with engine.begin() as conn:
-        for r in rows:
-            conn.execute(text(UPSERT_SQL), r)
+        conn.execute(text(ENRICH_SQL), params)
 
-def search_items(access_token: str, query: dict) -> list[dict]:
-    url = "https://api.ebay.com/buy/browse/v1/item_summary/search"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "X-EBAY-C-MARKETPLACE-ID": EBAY_MARKETPLACE_ID
-    }
-    r = requests.get(url, headers=headers, params=query, timeout=30)
-    r.raise_for_status()
-    return r.json().get("itemSummaries", []) or []
+
+def _parse_ebay_time(s: str | None) -> datetime | None:
+    """eBay ISO zamanını ('2024-05-01T12:34:56.000Z') tz'siz UTC datetime'a çevirir."""
+    if not s:
+        return None
+    try:
+        return datetime.fromisoformat(s.replace("Z", "+00:00")).astimezone(timezone.utc).replace(tzinfo=None)
+    except ValueError:
+        return None
+
+
+def search_items(query: dict, since: datetime | None = None,
+                 status: dict | None = None) -> Iterator[list[dict]]:
+    """Arama sonuçlarını sayfa sayfa üretir; eBay'in `next` bağlantısını izler.
+
+    Sorgudaki `limit` (veya `max_items`) toplam ürün sınırıdır, `max_pages`
+    sayfa sınırıdır; sayfa boyutu eBay'in izin verdiği en fazla 200'dür.
+    `since` verilirse yalnızca o andan sonra listelenen ürünler istenir
+    (sort=newlyListed + itemStartDate filtresi); bu durumda limitler
+    uygulanmaz, daha eski bir ürüne ulaşılana kadar sayfalanır (güvenlik
+    sınırı INGEST_INCREMENTAL_MAX_PAGES). Güvenlik sınırı aramayı yarıda
+    keserse `status["truncated"]` True olur.
+    """
+    params = {k: v for k, v in query.items() if k not in QUERY_CONTROL_KEYS}
+    if since is not None:
+        max_items = float("inf")
+        max_pages = INGEST_INCREMENTAL_MAX_PAGES
+        params["limit"] = EBAY_PAGE_SIZE_MAX
+    else:
+        max_items = int(query.get("max_items") or query.get("limit") or EBAY_PAGE_SIZE_MAX)
+        max_pages = int(query.get("max_pages") or EBAY_MAX_PAGES)
+        params["limit"] = min(max_items, EBAY_PAGE_SIZE_MAX)
+    if _is_incremental(query):
+        params["sort"] = "newlyListed"
+    if since is not None:
+        start = f"itemStartDate:[{since:%Y-%m-%dT%H:%M:%S}.000Z..]"
+        params["filter"] = f"{params['filter']},{start}" if params.get("filter") else start
+
+    def _get(url: str, params: dict | None, token: str):
+        ebay_rate_limiter.acquire()
+        headers = {
+            "Authorization": f"Bearer {token}",
+            "X-EBAY-C-MARKETPLACE-ID": EBAY_MARKETPLACE_ID
+        }
+        return http_client.get(url, headers=headers, params=params)
+
+    url = EBAY_SEARCH_URL
+    seen = 0
+    for _ in range(max_pages):
+        r = _get(url, params, token_manager.get())
+        if r.status_code == 401:
+            # Token iptal edilmiş ya da süresi erken dolmuş olabilir: bir kez yenileyip tekrar dene
+            print("[Search] 401, token yenileniyor", flush=True)
+            r = _get(url, params, token_manager.get(force=True))
+        r.raise_for_status()
+        if response_recorder is not None:
+            # Kayıt ham yanıtı ister: tüm belge çözülür
+            body = json_loads(r.content)
+            response_recorder.write(query, body)
+        else:
+            body = parse_search_page(r.content)
+        items = body.get("itemSummaries") or []
+        if since is None:
+            items = items[:max_items - seen]
+        reached_old = False
+        if since is not None:
+            fresh = [it for it in items
+                     if (_parse_ebay_time(it.get("itemCreationDate")) or since) >= since]
+            reached_old = len(fresh) < len(items)
+            items = fresh
+        if items:
+            yield items
+        seen += len(items)
+        # `next` tam URL'dir (offset/limit dahil); sonraki sayfada params gönderilmez
+        url, params = body.get("next"), None
+        if not url or not items or reached_old or seen >= max_items:
+            break
+    else:
+        if since is not None and status is not None:
+            status["truncated"] = True
+            print(f"[Search] artımlı arama {max_pages} sayfada kesildi; filigran ilerletilmiyor: {query}",
+                  flush=True)
+
+
+# ------------------- Yanıt kaydı ve tekrar oynatma -------------------
+# INGEST_RECORD_DIR verilirse her arama sayfası ham haliyle gzip JSONL'e yazılır;
+# kayıtlar `--replay` ile ağ ve eBay kotası kullanmadan tekrar yüklenebilir.
+INGEST_RECORD_DIR = os.getenv("INGEST_RECORD_DIR") or ""
+REPLAY_BATCH_ROWS = int(os.getenv("REPLAY_BATCH_ROWS", str(BULK_COPY_THRESHOLD)))
+
+
+class ResponseRecorder:
+    """Ham search yanıtlarını satır başına bir sayfa olacak şekilde gzip JSONL'e yazar.
+
+    Satır: {"recorded_at", "query_key", "query", "body"}. Eşzamanlı sorgular
+    aynı dosyaya kilitle yazar; dosya UTC saatine göre döndürülür.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._fh = None
+        self._path = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _file_for(self, now: datetime):
+        path = os.path.join(self.directory, f"ebay-search-{now:%Y%m%dT%H}.jsonl.gz")
+        if path != self._path:
+            if self._fh is not None:
+                self._fh.close()
+            self._fh = gzip.open(path, "at", encoding="utf-8")
+            self._path = path
+        return self._fh
+
+    def write(self, query: dict, body: dict):
+        now = _utcnow()
+        line = json.dumps({
+            "recorded_at": now.isoformat(),
+            "query_key": _query_key(query),
+            "query": query,
+            "body": body,
+        }, ensure_ascii=False, separators=(",", ":"))
+        try:
+            with self._lock:
+                fh = self._file_for(now)
+                fh.write(line + "\n")
+                fh.flush()
+        except OSError as e:
+            # Kayıt yan üründür; ingest'i durdurmaz
+            print(f"[Record] yazılamadı: {e}", flush=True)
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = self._path = None
+
+
+response_recorder = ResponseRecorder(INGEST_RECORD_DIR) if INGEST_RECORD_DIR else None
+
+
+def _open_text(path: str):
+    return gzip.open(path, "rt", encoding="utf-8") if path.endswith(".gz") else open(path, "r", encoding="utf-8")
+
+
+def iter_recorded_pages(path: str, query_key: str | None = None) -> Iterator[tuple[datetime | None, list[dict]]]:
+    """Kayıt dosyasını satır satır okuyup (kayıt zamanı, ürünler) üretir.
+
+    .jsonl / .jsonl.gz: ResponseRecorder satırları. .json: tek bir search
+    yanıtı ya da items_sample.json gibi düz ürün listesi. Dosya belleğe
+    alınmaz; bozuk satırlar atlanır.
+    """
+    with _open_text(path) as f:
+        if not path.endswith((".jsonl", ".jsonl.gz")):
+            data = json.load(f)
+            items = data if isinstance(data, list) else data.get("itemSummaries") or []
+            yield None, items
+            return
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                rec = json_loads(line)
+            except json.JSONDecodeError as e:
+                print(f"[Replay] {path}:{n} atlandı: {e}", flush=True)
+                continue
+            if query_key and rec.get("query_key") != query_key:
+                continue
+            recorded = rec.get("recorded_at")
+            yield (datetime.fromisoformat(recorded) if recorded else None,
+                   (rec.get("body") or {}).get("itemSummaries") or [])
 
 
 # ------------------- Gemini fiyat tahmini -------------------
-def predict_prices_with_gemini(items: list[dict]) -> list[float | None]:
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "models/gemini-2.5-flash")
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "3"))
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "60"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+GEMINI_BACKOFF_SECONDS = float(os.getenv("GEMINI_BACKOFF_SECONDS", "5"))
+GEMINI_BATCH_MIN = int(os.getenv("GEMINI_BATCH_MIN", "5"))
+GEMINI_BATCH_MAX = int(os.getenv("GEMINI_BATCH_MAX", "50"))
+GEMINI_BATCH_TOKENS = int(os.getenv("GEMINI_BATCH_TOKENS", "4000"))     # istem başına yaklaşık token
+GEMINI_TARGET_LATENCY = float(os.getenv("GEMINI_TARGET_LATENCY", "20"))  # saniye
+
+gemini_rate_limiter = TokenBucket(GEMINI_RPM / 60, max(1, GEMINI_MAX_CONCURRENCY))
+
+GEMINI_MISSING_RETRIES = int(os.getenv("GEMINI_MISSING_RETRIES", "1"))
+GEMINI_MIN_CONFIDENCE = float(os.getenv("GEMINI_MIN_CONFIDENCE", "0"))
+
+GEMINI_PROMPT_HEADER = (
+    "Aşağıdaki ürünler için piyasa fiyat tahmini yap.\n"
+    "Her ürün için item_id'yi aynen geri yaz; estimate ürünün para biriminde tahmini\n"
+    "piyasa fiyatı, confidence 0 ile 1 arasında güven değeridir.\n"
+)
+
+# Yanıt şeması: tahminler sıraya göre değil item_id ile eşleştirilir
+GEMINI_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "item_id": {"type": "string"},
+            "estimate": {"type": "number"},
+            "currency": {"type": "string"},
+            "confidence": {"type": "number"},
+        },
+        "required": ["item_id", "estimate"],
+    },
+}
+GEMINI_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": GEMINI_RESPONSE_SCHEMA,
+}
+
+
+def _prompt_line(it: dict) -> str:
+    return json.dumps({
+        "item_id": it.get("item_id"),
+        "title": it.get("title"),
+        "condition": it.get("condition_display_name"),
+        "price": None if it.get("price_value") is None else str(it.get("price_value")),
+        "currency": it.get("price_currency"),
+    }, ensure_ascii=False) + "\n"
+
+
+def _approx_tokens(s: str) -> int:
+    return len(s) // 4 + 1
+
+
+class AdaptiveBatcher:
+    """Parti boyutunu gecikme ve hatalara göre ayarlar (AIMD).
+
+    Başarılı ve hızlı yanıtlarda boyut yavaşça büyür, yavaş yanıtta küçülür,
+    hatada yarıya iner. Partiler ayrıca istem token bütçesiyle sınırlanır.
+    """
+
+    def __init__(self, start: int, lo: int, hi: int, token_budget: int, target_latency: float):
+        self.size = start
+        self.lo, self.hi = lo, hi
+        self.token_budget = token_budget
+        self.target_latency = target_latency
+        self._lock = threading.Lock()
+
+    def take(self, pending: deque) -> list[dict]:
+        with self._lock:
+            size = self.size
+        batch: list[dict] = []
+        tokens = _approx_tokens(GEMINI_PROMPT_HEADER)
+        while pending and len(batch) < size:
+            cost = _approx_tokens(_prompt_line(pending[0]))
+            if batch and tokens + cost > self.token_budget:
+                break
+            batch.append(pending.popleft())
+            tokens += cost
+        return batch
+
+    def record(self, latency: float, ok: bool):
+        with self._lock:
+            if not ok:
+                self.size = max(self.lo, self.size // 2)
+            elif latency > self.target_latency:
+                self.size = max(self.lo, int(self.size * 0.75))
+            else:
+                self.size = min(self.hi, self.size + 2)
+
+
+gemini_batcher = AdaptiveBatcher(20, GEMINI_BATCH_MIN, GEMINI_BATCH_MAX, GEMINI_BATCH_TOKENS, GEMINI_TARGET_LATENCY)
+
+
+def _generate_with_backoff(prompt: str):
+    """Hız sınırına uyarak Gemini'yi çağırır; 429/kota hatasında üstel geri çekilir."""
+    model = genai.GenerativeModel(GEMINI_MODEL, generation_config=GEMINI_GENERATION_CONFIG)
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        gemini_rate_limiter.acquire()
+        t = time.monotonic()
+        try:
+            resp = model.generate_content(prompt)
+            gemini_batcher.record(time.monotonic() - t, ok=True)
+            return resp
+        except (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests) as e:
+            gemini_batcher.record(time.monotonic() - t, ok=False)
+            if attempt == GEMINI_MAX_RETRIES:
+                raise
+            delay = GEMINI_BACKOFF_SECONDS * 2 ** attempt
+            print(f"[AI] kota/429, {delay:.0f}s bekleniyor: {e}", flush=True)
+            gemini_rate_limiter.penalize(delay)
+        except Exception:
+            gemini_batcher.record(time.monotonic() - t, ok=False)
+            raise
+
+
+def _parse_predictions(raw: str, items: list[dict]) -> dict[str, float]:
+    """JSON yanıtını ürün bazında doğrular; geçersiz/bilinmeyen kayıtlar atlanır."""
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        print(f"[AI] JSON çözülemedi: {raw[:200]}", flush=True)
+        return {}
+    by_id = {it["item_id"]: it for it in items}
+    preds: dict[str, float] = {}
+    for p in data if isinstance(data, list) else []:
+        if not isinstance(p, dict) or p.get("item_id") not in by_id:
+            continue
+        try:
+            est = float(p.get("estimate"))
+            conf = float(p.get("confidence", 1))
+        except (TypeError, ValueError):
+            continue
+        cur = p.get("currency")
+        expected = by_id[p["item_id"]].get("price_currency")
+        if not (0 < est < float("inf")) or conf < GEMINI_MIN_CONFIDENCE:
+            continue
+        if cur and expected and cur.upper() != expected.upper():
+            continue
+        preds[p["item_id"]] = est
+    return preds
+
+
+def predict_prices_with_gemini(items: list[dict]) -> dict[str, float]:
+    """item_id -> tahmin döner; yanıtta eksik kalan ürünler yeniden sorulur."""
     if not GEMINI_API_KEY or not items:
-        return [None] * len(items)
-
-    prompt = "Aşağıdaki ürünler için piyasa fiyat tahmini yap.\n" \
-             "Sadece rakam yaz ve her tahmini '||' ile ayır. Başka hiçbir şey yazma.\n"
-    for it in items:
-        title = it.get("title")
-        pv = it.get("price_value")
-        pc = it.get("price_currency")
-        prompt += f"- {title} (mevcut: {pv} {pc})\n"
-
-    model = genai.GenerativeModel("models/gemini-2.5-flash")
-    resp = model.generate_content(prompt)
-    raw = (getattr(resp, "text", "") or "").strip()
-
-    cands = raw.split("||") if "||" in raw else re.findall(r"[-+]?\d+(?:[.,]\d+)?", raw)
-    preds: list[float | None] = []
-    for s in cands:
-        s = s.strip().replace(",", ".")
+        return {}
+
+    preds: dict[str, float] = {}
+    todo = items
+    for _ in range(GEMINI_MISSING_RETRIES + 1):
+        prompt = GEMINI_PROMPT_HEADER + "".join(_prompt_line(it) for it in todo)
+        resp = _generate_with_backoff(prompt)
+        preds.update(_parse_predictions((getattr(resp, "text", "") or "").strip(), todo))
+        todo = [it for it in todo if it["item_id"] not in preds]
+        if not todo:
+            break
+        print(f"[AI] yanıtta eksik {len(todo)} ürün, yeniden soruluyor", flush=True)
+    return preds
+
+
+# ------------------- Başlık normalizasyonu ve kümeleme -------------------
+TITLE_STOPWORDS = {
+    "a", "an", "and", "the", "for", "with", "of", "in", "on", "to", "by", "from",
+    "uk", "free", "fast", "postage", "delivery", "genuine", "brand",
+}
+# "128 GB", "128gb", "1.5 TB" -> "128gb", "1.5tb"
+UNIT_RE = re.compile(r"(\d+(?:\.\d+)?)\s*(gb|tb|mb|mah|mm|cm|ml|kg|g|w|hz|inch|in|\")(?![a-z0-9])")
+UNIT_ALIASES = {"inch": "in", '"': "in"}
+# Harf ve rakam karışık kodlar (sm-g991b, a2633) ve 4-6 haneli set numaraları (75192)
+MODEL_RE = re.compile(r"\b(?=[a-z0-9-]*\d)(?=[a-z0-9-]*[a-z])[a-z0-9]+(?:-[a-z0-9]+)*\b|\b\d{4,6}\b")
+# Ürün serisi kelimesinden sonra gelen yalın numara da model numarasıdır ("iphone 13" -> "iphone13")
+SERIES_RE = re.compile(r"\b(iphone|ipad|pixel|galaxy|playstation|ps|xbox|switch|series|gen|generation|note)\s+(\d{1,3})\b")
+SERIES_ALIASES = {"playstation": "ps", "generation": "gen"}
+# Aynı serinin farklı modelleri; kümedekiyle birebir aynı olmalı ("13" ile "13 pro max" ayrı ürünlerdir)
+VARIANT_WORDS = {"pro", "max", "plus", "mini", "ultra", "lite", "fe", "se", "xl"}
+# Aksesuarlar cihazın kendisiyle aynı kümeye düşmemeli; "with charger" gibi
+# kutu içeriği sayılmaz
+ACCESSORY_RE = re.compile(r"(?<!with )(?<!and )(?<!\+ )\b(case|cover|protector|charger|cable|adapter|strap|skin"
+                          r"|holder|mount|dock|stand|sleeve|pouch|lens)(?:e?s)?\b")
+
+CLUSTER_NUM_PERM = int(os.getenv("CLUSTER_NUM_PERM", "64"))
+CLUSTER_BANDS = int(os.getenv("CLUSTER_BANDS", "16"))            # 16 bant x 4 satır ~ 0.5 benzerlik eşiği
+CLUSTER_MIN_JACCARD = float(os.getenv("CLUSTER_MIN_JACCARD", "0.6"))
+
+_MINHASH_PRIME = 4294967311  # 2^32'den büyük asal
+_rng = np.random.default_rng(20240501)  # imzalar süreçler arası aynı olmalı: sabit tohum
+_MINHASH_A = _rng.integers(1, 2 ** 31, CLUSTER_NUM_PERM, dtype=np.uint64)
+_MINHASH_B = _rng.integers(0, 2 ** 31, CLUSTER_NUM_PERM, dtype=np.uint64)
+_cluster_lock = threading.Lock()
+
+
+def title_tokens(title: str | None) -> list[str]:
+    """Küçük harf, birimleri birleştirilmiş, noktalama ve dolgu kelimeleri atılmış kelimeler."""
+    t = (title or "").lower()
+    t = UNIT_RE.sub(lambda m: m.group(1) + UNIT_ALIASES.get(m.group(2), m.group(2)), t)
+    return [w for w in re.findall(r"[a-z0-9]+(?:\.\d+)?[a-z]*", t) if w not in TITLE_STOPWORDS]
+
+
+def normalize_title(title: str | None) -> str:
+    return " ".join(title_tokens(title))
+
+
+def model_numbers(title: str | None) -> set[str]:
+    """Başlıktaki model/set numaraları, birimli özellikler (128gb, 27in) ve
+    varyant/aksesuar kelimeleri ("v:pro", "a:case")."""
+    t = (title or "").lower()
+    found = {m.replace("-", "") for m in MODEL_RE.findall(t)}
+    found |= {SERIES_ALIASES.get(series, series) + num for series, num in SERIES_RE.findall(t)}
+    tokens = title_tokens(title)
+    found |= {w for w in tokens if UNIT_RE.fullmatch(w)}
+    found |= {"v:" + w for w in tokens if w in VARIANT_WORDS}
+    return found | {"a:" + w for w in ACCESSORY_RE.findall(t)}
+
+
+def _split_specs(specs: set[str]) -> tuple[set[str], dict[str, set[str]], frozenset, frozenset]:
+    """model_numbers çıktısını (model numaraları, birim -> değerler, varyantlar, aksesuarlar) olarak ayırır."""
+    models, units, variants, accessories = set(), {}, set(), set()
+    for x in specs:
+        m = UNIT_RE.fullmatch(x)
+        if m:
+            units.setdefault(m.group(2), set()).add(m.group(1))
+        elif x.startswith("v:"):
+            variants.add(x[2:])
+        elif x.startswith("a:"):
+            accessories.add(x[2:])
+        else:
+            models.add(x)
+    return models, units, frozenset(variants), frozenset(accessories)
+
+
+def _specs_conflict(a: tuple, b: tuple) -> bool:
+    """İki ilan farklı model numarası, aynı birimde farklı değer, farklı varyant
+    taşıyorsa ya da yalnızca biri (veya farklı türden) aksesuarsa True."""
+    (models_a, units_a, variants_a, acc_a), (models_b, units_b, variants_b, acc_b) = a, b
+    if models_a and models_b and not (models_a & models_b):
+        return True
+    if variants_a != variants_b or bool(acc_a) != bool(acc_b) or (acc_a and not (acc_a & acc_b)):
+        return True
+    return any(not (units_a[u] & units_b[u]) for u in units_a.keys() & units_b.keys())
+
+
+def minhash_signature(tokens: list[str]) -> np.ndarray | None:
+    # Kelime sırası ilanlarda değişkendir; imza kelime kümesi üzerinden hesaplanır
+    shingles = set(tokens)
+    if not shingles:
+        return None
+    x = np.array([int.from_bytes(hashlib.blake2b(sh.encode(), digest_size=4).digest(), "little")
+                  for sh in shingles], dtype=np.uint64)
+    return ((_MINHASH_A[:, None] * x[None, :] + _MINHASH_B[:, None]) % _MINHASH_PRIME).min(axis=1)
+
+
+def _lsh_buckets(sig: np.ndarray) -> list[tuple[int, str]]:
+    rows = CLUSTER_NUM_PERM // CLUSTER_BANDS
+    return [(b, hashlib.sha1(sig[b * rows:(b + 1) * rows].tobytes()).hexdigest()[:16])
+            for b in range(CLUSTER_BANDS)]
+
+
+def assign_product_clusters(conn, rows: list[dict]):
+    """Satırlara product_cluster_id atar; uygun küme yoksa yenisini açar.
+
+    Aday kümeler LSH kovalarından bulunur, imza benzerliği CLUSTER_MIN_JACCARD
+    üstünde ve model numarası/kapasite gibi özellikleri çelişmeyen en yakın
+    küme seçilir.
+    """
+    prepared = []
+    for r in rows:
+        sig = minhash_signature(title_tokens(r.get("title")))
+        if sig is None:
+            r["product_cluster_id"] = None
+            continue
+        prepared.append((r, sig, _lsh_buckets(sig), model_numbers(r.get("title"))))
+    if not prepared:
+        return
+
+    with _cluster_lock:
+        keys = {key for _, _, buckets, _ in prepared for key in buckets}
+        # Kova özeti bant içinde 64 bittir; bucket indeksiyle aranır, bant burada süzülür
+        cand = conn.execute(text("""
+            SELECT l.band, l.bucket, c.cluster_id, c.signature, c.model_numbers
+            FROM product_cluster_lsh l
+            JOIN product_clusters c ON c.cluster_id = l.cluster_id
+            WHERE l.bucket IN :buckets
+        """).bindparams(bindparam("buckets", expanding=True)),
+            {"buckets": sorted({h for _, h in keys})}).all()
+        by_bucket: dict[tuple[int, str], list[tuple]] = {}
+        parsed: dict[str, tuple] = {}
+        for band, bucket, cid, sig, models in cand:
+            if (band, bucket) not in keys:
+                continue
+            if cid not in parsed:
+                parsed[cid] = (np.frombuffer(bytes(sig), dtype=np.uint64),
+                               _split_specs(set(filter(None, (models or "").split(",")))))
+            by_bucket.setdefault((band, bucket), []).append((cid, *parsed[cid]))
+
+        new_clusters, new_buckets = [], []
+        for r, sig, buckets, models in prepared:
+            specs = _split_specs(models)
+            # Aynı küme birden çok bantta eşleşebilir: her aday bir kez karşılaştırılır
+            candidates = {cid: (csig, cspecs) for key in buckets for cid, csig, cspecs in by_bucket.get(key, ())}
+            ok = [(cid, csig) for cid, (csig, cspecs) in candidates.items() if not _specs_conflict(specs, cspecs)]
+            best = None
+            if ok:
+                sims = (np.stack([csig for _, csig in ok]) == sig).mean(axis=1)
+                i = int(sims.argmax())
+                if sims[i] >= CLUSTER_MIN_JACCARD:
+                    best = ok[i][0]
+            if best is None:
+                best = "pc_" + hashlib.sha1(sig.tobytes()).hexdigest()[:16]
+                new_clusters.append({"cluster_id": best, "signature": sig.tobytes(),
+                                     "model_numbers": ",".join(sorted(models)),
+                                     "title": r.get("title"), "created_at": _utcnow()})
+                for key in buckets:
+                    new_buckets.append({"band": key[0], "bucket": key[1], "cluster_id": best})
+                    # Aynı partideki sonraki ilanlar da bu kümeyi bulabilsin
+                    by_bucket.setdefault(key, []).append((best, sig, specs))
+            r["product_cluster_id"] = best
+
+        if new_clusters:
+            conn.execute(text("""
+                INSERT INTO product_clusters (cluster_id, signature, model_numbers, title, created_at)
+                VALUES (:cluster_id, :signature, :model_numbers, :title, :created_at)
+                ON CONFLICT (cluster_id) DO NOTHING
+            """), new_clusters)
+            conn.execute(text("""
+                INSERT INTO product_cluster_lsh (band, bucket, cluster_id)
+                VALUES (:band, :bucket, :cluster_id) ON CONFLICT DO NOTHING
+            """), new_buckets)
+
+
+# ------------------- Tahmin önbelleği -------------------
+PREDICTION_CACHE_TTL_HOURS = float(os.getenv("PREDICTION_CACHE_TTL_HOURS", "24"))
+PREDICTION_CACHE_HOT_SIZE = int(os.getenv("PREDICTION_CACHE_HOT_SIZE", "5000"))
+PREDICTION_CACHE_MAX_ROWS = int(os.getenv("PREDICTION_CACHE_MAX_ROWS", "200000"))
+
+def prediction_fingerprint(item: dict) -> str:
+    # Kümesi bilinen ürünlerde aynı ürünün farklı başlıkları aynı anahtarı paylaşır
+    key = "|".join([
+        item.get("product_cluster_id") or normalize_title(item.get("title")),
+        (item.get("condition_display_name") or "").lower(),
+        (item.get("price_currency") or "").upper(),
+        GEMINI_MODEL,
+    ])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class PredictionCache:
+    """İki katmanlı önbellek: süreç içi LRU (sıcak) + ai_prediction_cache tablosu.
+
+    Kayıtlar TTL sonunda geçersizdir; tablo en son kullanılanlara göre
+    PREDICTION_CACHE_MAX_ROWS satırla sınırlanır.
+    """
+
+    def __init__(self, ttl_hours: float, hot_size: int, max_rows: int):
+        self.ttl = timedelta(hours=ttl_hours)
+        self.hot_size = hot_size
+        self.max_rows = max_rows
+        self._hot: OrderedDict[str, tuple[float, datetime]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, fp: str, estimate: float, created_at: datetime):
+        with self._lock:
+            self._hot[fp] = (estimate, created_at)
+            self._hot.move_to_end(fp)
+            while len(self._hot) > self.hot_size:
+                self._hot.popitem(last=False)
+
+    def get_many(self, fps: list[str], stats: Counter) -> dict[str, float]:
+        now = _utcnow()
+        found: dict[str, float] = {}
+        with self._lock:
+            for fp in fps:
+                hit = self._hot.get(fp)
+                if hit and now - hit[1] < self.ttl:
+                    self._hot.move_to_end(fp)
+                    found[fp] = hit[0]
+                elif hit:
+                    del self._hot[fp]
+        stats["hot"] += len(found)
+
+        missing = [fp for fp in fps if fp not in found]
+        if missing:
+            with engine.connect().execution_options(sqlite_begin="IMMEDIATE") as conn, conn.begin():
+                rows = conn.execute(text("""
+                    SELECT fingerprint, estimate, created_at FROM ai_prediction_cache
+                    WHERE fingerprint IN :fps AND created_at > :cutoff
+                """).bindparams(bindparam("fps", expanding=True)),
+                    {"fps": missing, "cutoff": now - self.ttl}).all()
+                if rows:
+                    conn.execute(text("""
+                        UPDATE ai_prediction_cache SET last_hit_at = :now
+                        WHERE fingerprint IN :fps
+                    """).bindparams(bindparam("fps", expanding=True)),
+                        {"fps": [r.fingerprint for r in rows], "now": now})
+            for r in rows:
+                found[r.fingerprint] = float(r.estimate)
+                self._remember(r.fingerprint, float(r.estimate), r.created_at)
+            stats["db"] += len(rows)
+        stats["miss"] += len(fps) - len(found)
+        return found
+
+    def put_many(self, estimates: dict[str, float]):
+        if not estimates:
+            return
+        now = _utcnow()
+        with engine.begin() as conn:
+            conn.execute(text("""
+                INSERT INTO ai_prediction_cache (fingerprint, estimate, model, created_at, last_hit_at)
+                VALUES (:fingerprint, :estimate, :model, :now, :now)
+                ON CONFLICT (fingerprint) DO UPDATE SET
+                  estimate = EXCLUDED.estimate, created_at = EXCLUDED.created_at,
+                  last_hit_at = EXCLUDED.last_hit_at
+            """), [{"fingerprint": fp, "estimate": est, "model": GEMINI_MODEL, "now": now}
+                   for fp, est in estimates.items()])
+        for fp, est in estimates.items():
+            self._remember(fp, est, now)
+
+    def evict(self):
+        """Süresi dolanları ve boyut sınırını aşan en eski kullanılanları siler."""
+        with engine.begin() as conn:
+            expired = conn.execute(text("DELETE FROM ai_prediction_cache WHERE created_at <= :cutoff"),
+                                   {"cutoff": _utcnow() - self.ttl}).rowcount
+            overflow = conn.execute(text("""
+                DELETE FROM ai_prediction_cache WHERE last_hit_at < (
+                  SELECT last_hit_at FROM ai_prediction_cache
+                  ORDER BY last_hit_at DESC LIMIT 1 OFFSET :max_rows
+                )
+            """), {"max_rows": self.max_rows}).rowcount
+        if expired or overflow:
+            print(f"[Cache] silinen: süresi dolan={expired}, taşan={overflow}", flush=True)
+
+
+prediction_cache = PredictionCache(PREDICTION_CACHE_TTL_HOURS, PREDICTION_CACHE_HOT_SIZE, PREDICTION_CACHE_MAX_ROWS)
+
+
+def predict_prices_cached(items: list[dict], stats: Counter) -> list[float | None]:
+    """Önbellekte olmayan ürünleri Gemini'ye gönderir; sonuçları önbelleğe yazar."""
+    fps = [prediction_fingerprint(it) for it in items]
+    found = prediction_cache.get_many(list(set(fps)), stats)
+    # Aynı parmak izine sahip ürünler tek sefer sorulur
+    miss: dict[str, dict] = {}
+    for fp, it in zip(fps, items):
+        if fp not in found:
+            miss.setdefault(fp, it)
+    if miss:
+        preds = predict_prices_with_gemini(list(miss.values()))
+        fresh = {fp: preds[it["item_id"]] for fp, it in miss.items() if it["item_id"] in preds}
+        prediction_cache.put_many(fresh)
+        found.update(fresh)
+    return [found.get(fp) for fp in fps]
+
+
+# ------------------- Piyasa istatistikleri -------------------
+# Benzer ilanların (küme) gözlenen fiyatlarından sağlam istatistikler
+# (medyan, MAD, yüzdelikler) çıkarılır; yeni ilanlar buna göre toplu puanlanır.
+# Yalnızca belirsiz ya da az örnekli ilanlar Gemini'ye gider.
+MARKET_LOOKBACK_DAYS = int(os.getenv("MARKET_LOOKBACK_DAYS", "30"))
+MARKET_MIN_SAMPLES = int(os.getenv("MARKET_MIN_SAMPLES", "5"))
+MARKET_TITLE_TOKENS = int(os.getenv("MARKET_TITLE_TOKENS", "4"))
+MARKET_DEAL_Z = float(os.getenv("MARKET_DEAL_Z", "2.0"))         # z <= -DEAL_Z: kesin fırsat
+MARKET_FAIR_Z = float(os.getenv("MARKET_FAIR_Z", "1.0"))         # z >  -FAIR_Z: kesin fırsat değil
+
+# Her ilan penceredeki son fiyatıyla tek örnektir; {scope} aday kümelerle sınırlar
+MARKET_HISTORY_SQL = """
+SELECT item_id, title, product_cluster_id, category_id, condition_display_name, brand,
+       currency, price_value
+FROM (
+  SELECT i.item_id, i.title, i.product_cluster_id, i.category_id, i.condition_display_name,
+         i.brand, h.currency, h.price_value,
+         ROW_NUMBER() OVER (PARTITION BY h.item_id ORDER BY h.observed_at DESC) AS rn
+  FROM ebay_price_history h
+  JOIN ebay_items i ON i.item_id = h.item_id
+  WHERE h.observed_at > :cutoff AND i.last_seen_utc > :cutoff AND {scope}
+) latest
+WHERE rn = 1 AND price_value > 0
+"""
+# Kümeli ilanlar kümelerine göre (ebay_items_cluster_idx); kümesiz ilanların
+# anahtarı başlıktan türediği için yalnızca kümesiz ilanlar kategoriye göre
+# (ebay_items_category_seen_idx) yüklenir
+MARKET_SCOPE_CLUSTER = "i.product_cluster_id IN :keys"
+MARKET_SCOPE_CATEGORY = "i.product_cluster_id IS NULL AND i.category_id IN :keys"
+
+MARKET_SCORE_SQL = """
+UPDATE ebay_items SET market_median = :market_median, deal_score = :deal_score
+WHERE item_id = :item_id AND content_hash IS NOT DISTINCT FROM :content_hash
+"""
+
+
+def market_cluster_key(r: dict) -> str:
+    """Ürün kümesi (yoksa normalize başlığın ilk kelimeleri) + kategori + durum + marka + para birimi."""
+    product = r.get("product_cluster_id")
+    if not product:
+        product = " ".join(sorted(normalize_title(r.get("title")).split()[:MARKET_TITLE_TOKENS]))
+    return "|".join([
+        product,
+        r.get("category_id") or "",
+        (r.get("condition_display_name") or "").lower(),
+        (r.get("brand") or "").lower(),
+        (r.get("price_currency") or r.get("currency") or "").upper(),
+    ])
+
+
+def market_stats(rows: list[dict]) -> dict[str, dict]:
+    """Küme başına n, medyan, MAD; bir-dışarıda puanlama için fiyatlar ve
+    ilan başına örnek fiyatı (item_id -> fiyat) da tutulur."""
+    if not rows:
+        return {}
+    keys = np.array([market_cluster_key(r) for r in rows], dtype=object)
+    prices = np.array([float(r["price_value"]) for r in rows])
+    ids = [r.get("item_id") for r in rows]
+    uniq, inv = np.unique(keys, return_inverse=True)
+    order = np.argsort(inv, kind="stable")
+    bounds = np.cumsum(np.bincount(inv))
+    stats = {}
+    start = 0
+    for k, end in zip(uniq, bounds):
+        idx = order[start:end]
+        p = prices[idx]
+        med = float(np.median(p))
+        stats[k] = {"n": len(p), "median": med, "mad": float(np.median(np.abs(p - med))),
+                    "prices": p, "samples": {ids[i]: prices[i] for i in idx if ids[i]}}
+        start = end
+    return stats
+
+
+def _leave_one_out(c: dict, item_id: str) -> tuple[int, float, float]:
+    """İlan kümenin örneklerindense kendi fiyatı çıkarılmış (n, medyan, MAD)."""
+    own = c["samples"].get(item_id)
+    if own is None:
+        return c["n"], c["median"], c["mad"]
+    p = c["prices"]
+    p = np.delete(p, int(np.flatnonzero(p == own)[0]))
+    if not len(p):
+        return 0, np.nan, np.nan
+    med = float(np.median(p))
+    return len(p), med, float(np.median(np.abs(p - med)))
+
+
+def load_market_stats(items: list[dict]) -> dict[str, dict]:
+    """Puanlanacak ilanların kümelerindeki ilanların son fiyatlarından istatistik çıkarır.
+
+    Puanlanan ilanın kendi örneği score_items'ta çıkarılır (bir-dışarıda);
+    aynı partideki diğer ilanlar birbirinin örneği olmaya devam eder.
+    """
+    scopes = (
+        (MARKET_SCOPE_CLUSTER,
+         sorted({r["product_cluster_id"] for r in items if r.get("product_cluster_id")})),
+        (MARKET_SCOPE_CATEGORY,
+         sorted({r["category_id"] for r in items if not r.get("product_cluster_id") and r.get("category_id")})),
+    )
+    cutoff = _utcnow() - timedelta(days=MARKET_LOOKBACK_DAYS)
+    rows = []
+    with engine.begin() as conn:
+        for scope, keys in scopes:
+            stmt = text(MARKET_HISTORY_SQL.format(scope=scope)).bindparams(bindparam("keys", expanding=True))
+            for i in range(0, len(keys), BULK_COPY_THRESHOLD):
+                rows += conn.execute(stmt, {"cutoff": cutoff, "keys": keys[i:i + BULK_COPY_THRESHOLD]}).mappings().all()
+    return market_stats(rows)
+
+
+def score_items(items: list[dict], stats: dict[str, dict]) -> tuple[list[dict], list[dict]]:
+    """İlanları toplu puanlar: (kesin puanlananlar, Gemini'ye gidecekler).
+
+    deal_score sağlam z-skorudur: (fiyat - medyan) / (1.4826 * MAD); negatif
+    değerler piyasanın altında demektir. Medyan ve MAD ilanın kendi örneği
+    çıkarılarak hesaplanır.
+    """
+    if not items:
+        return [], []
+    cl = [stats.get(market_cluster_key(r)) for r in items]
+    loo = np.array([_leave_one_out(c, r["item_id"]) if c else (0, np.nan, np.nan) for r, c in zip(items, cl)])
+    n, med, mad = loo[:, 0], loo[:, 1], loo[:, 2]
+    price = np.array([float(r["price_value"]) if r.get("price_value") is not None else np.nan for r in items])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = (price - med) / (1.4826 * mad)
+    enough = (n >= MARKET_MIN_SAMPLES) & (mad > 0) & np.isfinite(z)
+    confident = enough & ((z <= -MARKET_DEAL_Z) | (z > -MARKET_FAIR_Z))
+
+    scored, escalate = [], []
+    for r, ok, zi, mi in zip(items, confident, z, med):
+        if ok:
+            r["market_median"] = float(mi)
+            r["deal_score"] = float(zi)
+            scored.append(r)
+        else:
+            escalate.append(r)
+    return scored, escalate
+
+
+def update_market_scores(rows: list[dict]):
+    if not rows:
+        return
+    with engine.begin() as conn:
+        conn.execute(text(MARKET_SCORE_SQL), [
+            {"item_id": r["item_id"], "market_median": r["market_median"],
+             "deal_score": r["deal_score"], "content_hash": r.get("content_hash")} for r in rows
+        ])
+
+
+# ------------------- Telegram uyarıları -------------------
+TELEGRAM_DIGEST_WINDOW_SECONDS = float(os.getenv("TELEGRAM_DIGEST_WINDOW_SECONDS", "3"))
+TELEGRAM_DIGEST_THRESHOLD = int(os.getenv("TELEGRAM_DIGEST_THRESHOLD", "3"))
+TELEGRAM_DIGEST_MAX_ITEMS = int(os.getenv("TELEGRAM_DIGEST_MAX_ITEMS", "20"))
+TELEGRAM_SEND_RETRIES = int(os.getenv("TELEGRAM_SEND_RETRIES", "3"))
+TELEGRAM_MAX_MESSAGE_CHARS = 4096
+# Aynı küme + durum + para biriminden bir ilan uyarıldıysa, bu süre boyunca
+# kümedeki diğer ilanlar yalnızca daha ucuzsa uyarılır (saat)
+ALERT_CLUSTER_WINDOW_HOURS = float(os.getenv("ALERT_CLUSTER_WINDOW_HOURS", "24"))
+# Gönderilemeyen uyarılar telegram_alert_outbox'ta kalır ve artan aralıklarla
+# yeniden denenir; bu yaştan eski bekleyen uyarılar atılır (saat)
+TELEGRAM_RETRY_BASE_SECONDS = float(os.getenv("TELEGRAM_RETRY_BASE_SECONDS", "30"))
+TELEGRAM_RETRY_MAX_SECONDS = float(os.getenv("TELEGRAM_RETRY_MAX_SECONDS", "900"))
+ALERT_OUTBOX_MAX_AGE_HOURS = float(os.getenv("ALERT_OUTBOX_MAX_AGE_HOURS", "24"))
+
+ALERT_RECORD_SQL = """
+INSERT INTO telegram_alerts (item_id, alerted_price, alerted_at)
+VALUES (:item_id, :alerted_price, :alerted_at)
+ON CONFLICT (item_id) DO UPDATE SET
+  alerted_price = EXCLUDED.alerted_price,
+  alerted_at = EXCLUDED.alerted_at
+"""
+
+
+def _alert_cluster_key(r: dict) -> tuple:
+    return (r["product_cluster_id"], (r.get("condition_display_name") or "").lower(),
+            (r.get("price_currency") or "").upper())
+
+
+def _alert_estimate(r: dict) -> float:
+    """Uyarıdaki tahmini değer: Gemini tahmini, yoksa küme medyanı."""
+    return float(r.get("ai_price_estimate") or r["market_median"])
+
+
+def _format_alert(r: dict) -> str:
+    pv, ai = float(r["price_value"]), _alert_estimate(r)
+    fark = (ai / pv - 1) * 100
+    return (
+        f"🔥 <b>Fiyat Uyarısı</b>\n\n"
+        f"<b>{html.escape(r.get('title') or '')}</b>\n"
+        f"Gerçek fiyat: <b>{pv:.2f}</b>\n"
+        f"Tahmini değer: <b>{ai:.2f}</b>\n"
+        f"Fark: <b>{fark:.1f}%</b>\n"
+        f"🔗 <a href='{html.escape(r.get('item_href') or '')}'>Ürünü Gör</a>"
+    )
+
+
+def _format_digest(rows: list[dict]) -> list[tuple[str, list[dict]]]:
+    """Uyarıları Telegram'ın mesaj boyu sınırına sığan özet mesajlara böler."""
+    messages: list[tuple[str, list[dict]]] = []
+    head = f"🔥 <b>{len(rows)} Fiyat Uyarısı</b>\n\n"
+    body, part = head, []
+    for r in rows:
+        pv, ai = float(r["price_value"]), _alert_estimate(r)
+        line = (f"• <a href='{html.escape(r.get('item_href') or '')}'>{html.escape(r.get('title') or '')}</a>\n"
+                f"   {pv:.2f} → {ai:.2f} ({(ai / pv - 1) * 100:+.1f}%)\n")
+        if part and len(body) + len(line) > TELEGRAM_MAX_MESSAGE_CHARS:
+            messages.append((body, part))
+            body, part = head, []
+        body += line
+        part.append(r)
+    if part:
+        messages.append((body, part))
+    return messages
+
+
+class AlertDispatcher:
+    """Fiyat uyarılarını arka planda, hız sınırına uyarak gönderir.
+
+    Aynı ilan, fiyatı son uyarıdakinden düşmedikçe tekrar uyarılmaz
+    (telegram_alerts tablosu). Aynı küme, durum ve para birimindeki diğer
+    ilanlar ALERT_CLUSTER_WINDOW_HOURS içinde yalnızca daha ucuzsa uyarılır.
+    Kısa sürede biriken uyarılar tek bir özet mesajda toplanır.
+
+    Kuyruğa giren her uyarı önce telegram_alert_outbox'a yazılır ve yalnızca
+    gönderilince silinir. Gönderilemeyen ya da kapanışta kuyrukta kalan
+    uyarılar kaybolmaz: gönderim artan aralıklarla yeniden denenir, süreç
+    yeniden başladığında resume() bekleyenleri kuyruğa geri alır.
+    """
+
+    def __init__(self):
+        self._queue: queue.Queue[dict] = queue.Queue()
+        self._pending: set[str] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._retry_at = 0.0
+        self._backoff = TELEGRAM_RETRY_BASE_SECONDS
+
+    def _filter_new(self, rows: list[dict]) -> list[dict]:
+        # Aynı küme + durum + para biriminden tek (en ucuz) ilan uyarılır
+        cheapest: dict[tuple, dict] = {}
+        for r in rows:
+            key = _alert_cluster_key(r) if r.get("product_cluster_id") else (r["item_id"],)
+            if key not in cheapest or float(r["price_value"]) < float(cheapest[key]["price_value"]):
+                cheapest[key] = r
+        rows = list(cheapest.values())
+        cids = sorted({r["product_cluster_id"] for r in rows if r.get("product_cluster_id")})
+        with engine.begin() as conn:
+            sent = dict(conn.execute(text("""
+                SELECT item_id, alerted_price FROM telegram_alerts WHERE item_id IN :ids
+            """).bindparams(bindparam("ids", expanding=True)), {"ids": [r["item_id"] for r in rows]}).all())
+            sent_cluster = {}
+            if cids:
+                for cid, cond, cur, price in conn.execute(text("""
+                    SELECT e.product_cluster_id, e.condition_display_name, e.price_currency, MIN(a.alerted_price)
+                    FROM telegram_alerts a JOIN ebay_items e ON e.item_id = a.item_id
+                    WHERE e.product_cluster_id IN :cids AND a.alerted_at > :since
+                    GROUP BY e.product_cluster_id, e.condition_display_name, e.price_currency
+                """).bindparams(bindparam("cids", expanding=True)), {
+                    "cids": cids, "since": _utcnow() - timedelta(hours=ALERT_CLUSTER_WINDOW_HOURS),
+                }).all():
+                    key = _alert_cluster_key({"product_cluster_id": cid, "condition_display_name": cond,
+                                              "price_currency": cur})
+                    sent_cluster[key] = min(price, sent_cluster.get(key, price))
+        fresh = []
+        with self._lock:
+            for r in rows:
+                if r["item_id"] in self._pending:
+                    continue
+                price = Decimal(str(r["price_value"]))
+                last = sent.get(r["item_id"])
+                if last is not None and price >= Decimal(str(last)):
+                    continue
+                last = sent_cluster.get(_alert_cluster_key(r)) if r.get("product_cluster_id") else None
+                if last is not None and price >= Decimal(str(last)):
+                    continue
+                self._pending.add(r["item_id"])
+                fresh.append(r)
+        return fresh
+
+    def submit(self, rows: list[dict]):
+        if not rows:
+            return
+        if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
+            print(f"[Alerts] Telegram ayarlı değil; {len(rows)} uyarı atlandı", flush=True)
+            return
+        fresh = self._filter_new(rows)
+        if not fresh:
+            return
+        try:
+            with engine.begin() as conn:
+                conn.execute(text("""
+                    INSERT INTO telegram_alert_outbox (item_id, queued_at) VALUES (:item_id, :now)
+                    ON CONFLICT (item_id) DO NOTHING
+                """), [{"item_id": r["item_id"], "now": _utcnow()} for r in fresh])
+        except Exception as e:
+            print(f"[Alerts] bekleyen uyarılar kaydedilemedi: {e}", flush=True)
+        for r in fresh:
+            self._queue.put(r)
+        self._start()
+
+    def resume(self):
+        """telegram_alert_outbox'taki bekleyen uyarıları kuyruğa geri alır."""
+        if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
+            return
+        with engine.begin() as conn:
+            expired = conn.execute(text("DELETE FROM telegram_alert_outbox WHERE queued_at < :cutoff"), {
+                "cutoff": _utcnow() - timedelta(hours=ALERT_OUTBOX_MAX_AGE_HOURS)}).rowcount
+            rows = conn.execute(text(
+                PREDICT_SELECT_SQL + "WHERE item_id IN (SELECT item_id FROM telegram_alert_outbox)"
+            )).mappings().all()
+        if expired:
+            print(f"[Alerts] {expired} eski bekleyen uyarı atıldı", flush=True)
+        with self._lock:
+            rows = [dict(r) for r in rows if r["item_id"] not in self._pending]
+            self._pending.update(r["item_id"] for r in rows)
+        for r in rows:
+            self._queue.put(r)
+        if rows:
+            print(f"[Alerts] {len(rows)} bekleyen uyarı yeniden kuyrukta", flush=True)
+            self._start()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="alerts", daemon=True)
+                self._thread.start()
+
+    def _record(self, rows: list[dict]):
+        now = _utcnow()
+        with engine.begin() as conn:
+            conn.execute(text(ALERT_RECORD_SQL), [
+                {"item_id": r["item_id"], "alerted_price": r["price_value"], "alerted_at": now} for r in rows
+            ])
+            conn.execute(text("DELETE FROM telegram_alert_outbox WHERE item_id IN :ids")
+                         .bindparams(bindparam("ids", expanding=True)), {"ids": [r["item_id"] for r in rows]})
+
+    def _defer(self, rows: list[dict]):
+        """Gönderilemeyen uyarılar outbox'ta kalır; gönderim bir süre durdurulur."""
+        try:
+            with engine.begin() as conn:
+                conn.execute(text("UPDATE telegram_alert_outbox SET attempts = attempts + 1 WHERE item_id IN :ids")
+                             .bindparams(bindparam("ids", expanding=True)), {"ids": [r["item_id"] for r in rows]})
+        except Exception as e:
+            print(f"[Alerts] bekleyen uyarı güncellenemedi: {e}", flush=True)
+        self._retry_at = time.monotonic() + self._backoff
+        print(f"[Alerts] {len(rows)} uyarı gönderilemedi; {self._backoff:.0f}s sonra yeniden denenecek", flush=True)
+        self._backoff = min(self._backoff * 2, TELEGRAM_RETRY_MAX_SECONDS)
+
+    def _collect(self) -> list[dict]:
         try:
-            preds.append(float(s))
-        except ValueError:
-            preds.append(None)
+            batch = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        # Patlamaları yakalamak için kısa bir süre daha topla
+        deadline = time.monotonic() + (0 if self._stop.is_set() else TELEGRAM_DIGEST_WINDOW_SECONDS)
+        while len(batch) < TELEGRAM_DIGEST_MAX_ITEMS:
+            try:
+                batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            if self._retry_at:
+                if self._stop.is_set():
+                    break  # bekleyenler outbox'ta; sonraki başlangıçta gönderilir
+                if time.monotonic() < self._retry_at:
+                    time.sleep(0.5)
+                    continue
+                self._retry_at = 0.0
+                try:
+                    self.resume()
+                except Exception as e:
+                    print(f"[Alerts] bekleyen uyarılar okunamadı: {e}", flush=True)
+            batch = self._collect()
+            if not batch:
+                continue
+            if len(batch) >= TELEGRAM_DIGEST_THRESHOLD:
+                messages = _format_digest(batch)
+            else:
+                messages = [(_format_alert(r), [r]) for r in batch]
+            failed = []
+            for msg, rows in messages:
+                if self._retry_at:
+                    failed += rows  # gönderim durduruldu; sıradakiler denenmez
+                else:
+                    for _ in range(TELEGRAM_SEND_RETRIES):
+                        if send_telegram_message(msg):
+                            self._backoff = TELEGRAM_RETRY_BASE_SECONDS
+                            try:
+                                self._record(rows)
+                            except Exception as e:
+                                print(f"[Alerts] kayıt hatası: {e}", flush=True)
+                            break
+                    else:
+                        self._defer(rows)
+                        failed += rows
+                with self._lock:
+                    self._pending.difference_update(r["item_id"] for r in rows)
+            if failed:
+                # Kuyrukta kalanlar da outbox'tadır; yeniden denemede birlikte okunur
+                with self._lock:
+                    while True:
+                        try:
+                            self._pending.discard(self._queue.get_nowait()["item_id"])
+                        except queue.Empty:
+                            break
+
+    def close(self, timeout: float = 30):
+        """Kuyruktakileri gönderip iş parçacığını durdurur; gönderilemeyenler outbox'ta kalır."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+
+alert_dispatcher = AlertDispatcher()
+
 
-    if len(preds) < len(items):
-        preds += [None] * (len(items) - len(preds))
-    return preds[:len(items)]
+# ------------------- Sorgu zamanlaması -------------------
+POLL_TICK_MINUTES = float(os.getenv("POLL_TICK_MINUTES", "5"))       # ingest hattının çalışma sıklığı
+POLL_MIN_MINUTES = float(os.getenv("POLL_MIN_MINUTES", "5"))
+POLL_MAX_MINUTES = float(os.getenv("POLL_MAX_MINUTES", "240"))
+POLL_START_MINUTES = float(os.getenv("POLL_START_MINUTES", "30"))
+POLL_HOT_CHURN = float(os.getenv("POLL_HOT_CHURN", "5"))            # bu kadar yeni/değişen ürün = sıcak sorgu
+POLL_EWMA_ALPHA = float(os.getenv("POLL_EWMA_ALPHA", "0.5"))
+
+QUERY_STATE_UPSERT_SQL = """
+INSERT INTO ebay_query_state
+  (query_key, interval_seconds, next_run_utc, last_run_utc, last_churn, churn_ewma, watermark_utc)
+VALUES (:query_key, :interval_seconds, :next_run_utc, :last_run_utc, :last_churn, :churn_ewma, :watermark_utc)
+ON CONFLICT (query_key) DO UPDATE SET
+  interval_seconds = EXCLUDED.interval_seconds,
+  next_run_utc = EXCLUDED.next_run_utc,
+  last_run_utc = EXCLUDED.last_run_utc,
+  last_churn = EXCLUDED.last_churn,
+  churn_ewma = EXCLUDED.churn_ewma,
+  watermark_utc = EXCLUDED.watermark_utc
+"""
+
+
+def _query_key(q: dict) -> str:
+    return json.dumps(q, sort_keys=True, ensure_ascii=False)
+
+
+def load_query_state() -> dict[str, dict]:
+    with engine.begin() as conn:
+        rows = conn.execute(text("SELECT * FROM ebay_query_state")).mappings().all()
+    return {r["query_key"]: dict(r) for r in rows}
+
+
+def next_query_state(key: str, prev: dict | None, churn: int | None, now: datetime,
+                     watermark: datetime | None = None) -> dict:
+    """Son yoklamanın churn'üne (yeni+değişen) göre sorgunun bir sonraki aralığını hesaplar.
+
+    Sakin sorgularda aralık ikiye katlanır (üstel geri çekilme), sıcak
+    sorgularda yarıya iner; hata durumunda (churn=None) aralık korunur.
+    Filigran (en yeni itemCreationDate) yalnızca ileri gider.
+    """
+    old_wm = prev.get("watermark_utc") if prev else None
+    if old_wm and (watermark is None or watermark < old_wm):
+        watermark = old_wm
+    interval = prev["interval_seconds"] if prev else POLL_START_MINUTES * 60
+    ewma = prev["churn_ewma"] if prev else None
+    if churn is not None:
+        ewma = churn if ewma is None else POLL_EWMA_ALPHA * churn + (1 - POLL_EWMA_ALPHA) * ewma
+        if ewma < 1:
+            interval *= 2
+        elif ewma >= POLL_HOT_CHURN:
+            interval /= 2
+    interval = int(min(max(interval, POLL_MIN_MINUTES * 60), POLL_MAX_MINUTES * 60))
+    return {
+        "query_key": key, "interval_seconds": interval,
+        "next_run_utc": now + timedelta(seconds=interval), "last_run_utc": now,
+        "last_churn": churn, "churn_ewma": ewma or 0.0, "watermark_utc": watermark,
+    }
+
+
+def save_query_state(state: dict):
+    with engine.begin() as conn:
+        conn.execute(text(QUERY_STATE_UPSERT_SQL), state)
 
 
 # ------------------- İşler -------------------
+# Write-behind: sorgulardan gelen satırlar tamponda birleşir ve tek toplu
+# işlemde yazılır (satır sayısı ya da en eski satırın yaşı eşiği aşınca)
+INGEST_FLUSH_ROWS = int(os.getenv("INGEST_FLUSH_ROWS", "2000"))
+INGEST_FLUSH_SECONDS = float(os.getenv("INGEST_FLUSH_SECONDS", "10"))
+
+
+class IngestSink:
+    """Düzleştirilmiş satırları sorgular arası tamponlayıp toplu yazar.
+
+    Aynı item_id birden çok sorgudan (ya da sayfadan) gelirse en son görülen
+    satır kalır ve bir kez yazılır. Boşaltma tek seferde tek işlemdir;
+    başarısız olursa satırlar tampona geri konur ve hata yükseltilir.
+    add() içinde tetiklenen boşaltmanın hatası sorgu iş parçacığına
+    yükseltilmez: satırlar tamponda kalır, sonucu işin son flush()'ı belirler.
+    Hangi sorgunun hangi ilanı getirdiği tutulur, böylece değişen ilanlar
+    sorgu başına churn olarak sayılabilir. keep_history=True (tekrar oynatma)
+    iken birleştirilen satırların her gözlemi fiyat geçmişine yazılır.
+    """
+
+    def __init__(self, max_rows: int, max_age: float, keep_history: bool = False):
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.keep_history = keep_history
+        self._history: list[dict] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._rows: dict[str, dict] = {}
+        self._origins: dict[str, set[str]] = {}
+        self._first_at: float | None = None
+        self._hold_until = 0.0  # başarısız boşaltmadan sonra add() bir süre yeniden denemez
+        self.stats = Counter()
+        self.changed_ids: set[str] = set()
+        self.churn: Counter = Counter()
+
+    def add(self, key: str, rows: list[dict]):
+        with self._lock:
+            if self._first_at is None:
+                self._first_at = time.monotonic()
+            if self.keep_history:
+                self._history.extend(rows)
+            for r in rows:
+                old = self._rows.get(r["item_id"])
+                if old is not None:
+                    self.stats["duplicate"] += 1
+                    if old["last_seen_utc"] > r["last_seen_utc"]:
+                        self._origins[r["item_id"]].add(key)
+                        continue
+                self._rows[r["item_id"]] = r
+                self._origins.setdefault(r["item_id"], set()).add(key)
+            now = time.monotonic()
+            due = now >= self._hold_until and (len(self._rows) >= self.max_rows
+                                               or now - self._first_at >= self.max_age)
+        if due:
+            try:
+                self.flush()
+            except Exception as e:
+                with self._lock:
+                    self._hold_until = time.monotonic() + self.max_age
+                print(f"[Ingest] ara boşaltma başarısız, satırlar tamponda bekliyor: {e}", flush=True)
+
+    def flush(self):
+        # Boşaltmalar sıralıdır: aynı ilanlar eşzamanlı işlemlerde kilitlenmez
+        with self._flush_lock:
+            with self._lock:
+                rows, origins, history = self._rows, self._origins, self._history
+                self._rows, self._origins, self._history, self._first_at = {}, {}, [], None
+            if not rows:
+                return
+            changed: set[str] = set()
+            try:
+                stats = upsert_items(list(rows.values()), changed, history if self.keep_history else None)
+            except Exception:
+                with self._lock:
+                    self._history[:0] = history
+                    for item_id, r in rows.items():
+                        self._rows.setdefault(item_id, r)
+                        self._origins.setdefault(item_id, set()).update(origins[item_id])
+                    if self._first_at is None:
+                        self._first_at = time.monotonic()
+                raise
+            with self._lock:
+                self.stats += stats
+                self.stats["flushes"] += 1
+                self.changed_ids |= changed
+                for item_id in changed:
+                    for key in origins[item_id]:
+                        self.churn[key] += 1
+
+
+def _ingest_query(q: dict, sink: IngestSink, watermark: datetime | None) -> tuple[int, datetime | None]:
+    """Sorgunun sayfalarını tampona ekler; (ilan sayısı, görülen en yeni itemCreationDate) döner."""
+    since = None
+    if _is_incremental(q) and watermark is not None:
+        since = watermark - timedelta(seconds=INGEST_WATERMARK_OVERLAP_SECONDS)
+    key = _query_key(q)
+    seen = 0
+    newest = None
+    status: dict = {}
+    for page in search_items(q, since, status):
+        seen_at = _utcnow()  # sayfa başına tek zaman damgası
+        rows = [flatten_item(it, seen_at) for it in page if it.get("itemId")]
+        sink.add(key, rows)
+        seen += len(rows)
+        for it in page:
+            created = _parse_ebay_time(it.get("itemCreationDate"))
+            if created and (newest is None or created > newest):
+                newest = created
+    if status.get("truncated"):
+        # Eski filigran ile getirilen en eski ilan arasındakiler alınmadı:
+        # filigran yerinde kalır, bir sonraki yoklama aynı aralığı yeniden ister
+        newest = None
+    return seen, newest
+
+
+def _fmt_stats(stats: Counter) -> str:
+    return " ".join(f"{k}={stats[k]}" for k in ("inserted", "changed", "touched", "skipped", "stale", "priced"))
+
+
 def job_ingest_ebay():
-    print("[Ingest] started", flush=True)
-    ensure_schema()
-    token = get_access_token()
+    """Zamanı gelen sorguları sınırlı eşzamanlılıkla çalıştırır.
 
+    Satırlar IngestSink'te birleşip toplu yazılır. Sorgu durumları (aralık,
+    filigran) yalnızca son boşaltma başarılı olduktan sonra ilerletilir.
+    Dönüş: (sorgu başına sayaçlar, sorgu başına hatalar, yeni/değişen item_id'ler).
+    """
     with open("queries.json", "r", encoding="utf-8") as f:
         queries = json.load(f)
 
-    total = 0
+    now = _utcnow()
+    state = load_query_state()
+    due = [q for q in queries
+           if _query_key(q) not in state or state[_query_key(q)]["next_run_utc"] <= now]
+    if not due:
+        return {}, {}, set()
+    print(f"[Ingest] started, sorgu={len(due)}/{len(queries)}", flush=True)
+    get_access_token()
+    queries = due
+
+    sink = IngestSink(INGEST_FLUSH_ROWS, INGEST_FLUSH_SECONDS)
+    fetched: dict[str, tuple[int, datetime | None]] = {}
+    errors: dict[str, str] = {}
+    with ThreadPoolExecutor(max_workers=INGEST_MAX_IN_FLIGHT) as pool:
+        futures = {pool.submit(_ingest_query, q, sink, (state.get(_query_key(q)) or {}).get("watermark_utc")): q
+                   for q in queries}
+        for fut in as_completed(futures):
+            q = futures[fut]
+            try:
+                fetched[_query_key(q)] = fut.result()
+            except Exception as e:
+                errors[_query_key(q)] = str(e)
+                print(f"[Ingest] hata ({q}): {e}", flush=True)
+    try:
+        sink.flush()
+    except Exception as e:
+        # Yazılamayan satırlar bir sonraki yoklamada yeniden gelir; filigranlar ilerlemez
+        print(f"[Ingest] toplu yazım hatası: {e}", flush=True)
+        for key in fetched:
+            errors[key] = str(e)
+        fetched.clear()
+
+    results: dict[str, Counter] = {}
     for q in queries:
+        key = _query_key(q)
+        churn = newest = None
+        if key in fetched:
+            seen, newest = fetched[key]
+            churn = sink.churn[key]
+            results[key] = Counter(seen=seen, churn=churn)
+            print(f"Arama: {q} -> ilan={seen} yeni/değişen={churn}", flush=True)
+        nxt = next_query_state(key, state.get(key), churn, _utcnow(), newest)
         try:
-            print(f"Arama: {q}", flush=True)
-            items = search_items(token, q)
-            rows = [flatten_item(it) for it in items if it.get("itemId")]
-            upsert_items(rows)
-            print(f"Kaydedilen: {len(rows)}", flush=True)
-            total += len(rows)
-            time.sleep(0.5)
+            save_query_state(nxt)
         except Exception as e:
-            print(f"[Ingest] hata: {e}", flush=True)
-    print(f"[Ingest] done, upsert={total}", flush=True)
+            print(f"[Ingest] sorgu durumu yazılamadı ({q}): {e}", flush=True)
+    print(f"[Ingest] done, {_fmt_stats(sink.stats)} tekrar={sink.stats['duplicate']} "
+          f"yazım={sink.stats['flushes']}, hata={len(errors)}", flush=True)
+    return results, errors, sink.changed_ids
 
 
-def job_predict_prices():
-    if not GEMINI_API_KEY:
-        print("[AI] GEMINI_API_KEY yok; atlandı.", flush=True)
+def job_replay(paths: list[str], query_key: str | None = None) -> set[str]:
+    """Kaydedilmiş yanıtları flatten_item -> upsert_items üzerinden yükler.
+
+    Hız sınırı ve ağ yoktur; sayfalar REPLAY_BATCH_ROWS satırlık partiler
+    halinde yazılır (büyük partiler COPY yolunu kullanır). last_seen_utc
+    kayıt zamanıdır; her kayıtlı gözlem fiyat geçmişine yazılır, böylece
+    geçmiş geriye dönük doldurulabilir. Kayıtlı satırdan eski gözlemler
+    ebay_items'ı ezmez. Sorgu zamanlama durumu (aralık, watermark) değiştirilmez.
+    """
+    ensure_schema()
+    sink = IngestSink(REPLAY_BATCH_ROWS, float("inf"), keep_history=True)
+    pages = 0
+    t0 = time.monotonic()
+    for path in paths:
+        for recorded_at, items in iter_recorded_pages(path, query_key):
+            pages += 1
+            sink.add(path, [flatten_item(it, recorded_at) for it in items if it.get("itemId")])
+    sink.flush()
+    stats, changed_ids = sink.stats, sink.changed_ids
+    dt = time.monotonic() - t0
+    rows = sum(stats[k] for k in ("inserted", "changed", "touched", "skipped", "stale"))
+    print(f"[Replay] done, dosya={len(paths)} sayfa={pages} {_fmt_stats(stats)} "
+          f"süre={dt:.1f}s ({rows / dt if dt else 0:,.0f} satır/s)", flush=True)
+    return changed_ids
+
+
+def job_price_history_retention():
+    """Bu ay ve gelecek ayın bölümlerini önceden oluşturur, saklama süresini
+    aşan aylık bölümleri DROP eder (büyük DELETE yerine).
+
+    Varsayılan bölüme düşmüş satırlar, saklama süresi içindeyse kendi aylık
+    bölümlerine taşınır; eskiyse DELETE ile silinir. SQLite'ta geçmiş
+    bölümlü değildir; eski satırlar DELETE ile silinir.
+    """
+    cutoff = _month_start(_utcnow())
+    for _ in range(PRICE_HISTORY_RETENTION_MONTHS):
+        cutoff = _month_start(cutoff - timedelta(days=1))
+    if DB_BACKEND == "sqlite":
+        with engine.begin() as conn:
+            n = conn.execute(text("DELETE FROM ebay_price_history WHERE observed_at < :cutoff"),
+                             {"cutoff": cutoff}).rowcount
+        print(f"[Retention] {n} eski fiyat gözlemi silindi", flush=True)
+        return
+    this_month = _month_start(_utcnow())
+    with engine.begin() as conn:
+        stranded = {_month_start(m) for m in conn.execute(text("""
+            SELECT DISTINCT date_trunc('month', observed_at) FROM ebay_price_history_default
+            WHERE observed_at >= :cutoff
+        """), {"cutoff": cutoff}).scalars()}
+    for month in sorted(stranded | {this_month, _month_start(this_month + timedelta(days=32))}):
+        try:
+            _create_history_partition(month, move_default=True)
+            with _history_partitions_lock:
+                _history_partitions.add(month)
+                _history_partition_retry_at.pop(month, None)
+        except Exception as e:
+            print(f"[Retention] bölüm oluşturulamadı ({month:%Y-%m}): {e}", flush=True)
+    with engine.begin() as conn:
+        n = conn.execute(text("DELETE FROM ebay_price_history_default WHERE observed_at < :cutoff"),
+                         {"cutoff": cutoff}).rowcount
+        if n:
+            print(f"[Retention] varsayılan bölümden {n} eski gözlem silindi", flush=True)
+        parts = conn.execute(text("""
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.oid = 'ebay_price_history'::regclass
+        """)).scalars().all()
+        for name in parts:
+            m = re.fullmatch(r"ebay_price_history_(\d{4})(\d{2})", name)
+            if not m or datetime(int(m.group(1)), int(m.group(2)), 1) >= cutoff:
+                continue
+            conn.execute(text(f"DROP TABLE IF EXISTS {name}"))
+            with _history_partitions_lock:
+                _history_partitions.discard(datetime(int(m.group(1)), int(m.group(2)), 1))
+            print(f"[Retention] bölüm silindi: {name}", flush=True)
+
+
+def _predict_batch(subset: list[dict]) -> tuple[list[dict], Counter]:
+    stats = Counter()
+    preds = predict_prices_cached(subset, stats)
+    for r, p in zip(subset, preds):
+        r["ai_price_estimate"] = p
+    return subset, stats
+
+
+def _alert_deals(subset: list[dict]):
+    deals = []
+    for r in subset:
+        pv = r.get("price_value")
+        ai = r.get("ai_price_estimate") or r.get("market_median")
+        if pv and ai:
+            try:
+                if float(ai) >= float(pv) * margin_rate:
+                    deals.append(r)
+            except Exception as e:
+                print(f"[WarnCheck] hata: {e}", flush=True)
+    try:
+        alert_dispatcher.submit(deals)
+    except Exception as e:
+        print(f"[WarnCheck] hata: {e}", flush=True)
+
+
+PREDICT_SELECT_SQL = """
+SELECT item_id, title, price_value, price_currency, item_href, seller_username,
+       condition_display_name, category_id, category_name, brand, last_seen_utc,
+       ai_price_estimate, market_median, deal_score, content_hash, product_cluster_id
+FROM ebay_items
+"""
+UNSCORED_SQL = "ai_price_estimate IS NULL AND deal_score IS NULL"
+# ebay_items_unpriced_recent_idx ile sıralama yapılmadan okunur
+BACKLOG_SELECT_SQL = PREDICT_SELECT_SQL + f"""WHERE {UNSCORED_SQL}
+ORDER BY last_seen_utc DESC
+LIMIT 200
+"""
+
+_predict_lock = threading.Lock()
+
+
+def job_predict_prices(item_ids: set[str] | None = None):
+    """Tahmini olmayan ürünleri fiyatlar.
+
+    item_ids verilirse (ingest'ten gelen yeni/değişen ürünler) yalnızca onlara
+    bakılır; None ise tahmini eksik en yeni 200 ürün taranır (birikmiş iş).
+    Önce yerel piyasa istatistikleriyle puanlanır, yalnızca belirsiz veya az
+    örnekli ürünler Gemini'ye gider.
+    """
+    if item_ids is not None and not item_ids:
+        print("[AI] yeni/değişen ürün yok; atlandı.", flush=True)
         return
 
+    # Ingest hattı ve birikmiş iş taraması aynı anda tahmin yapmasın
+    with _predict_lock:
+        _predict_prices(item_ids)
+
+
+def _predict_prices(item_ids: set[str] | None):
     print("[AI] started", flush=True)
-    batch = 20
     with engine.begin() as conn:
-        rows = conn.execute(text("""
-            SELECT item_id, title, price_value, price_currency, item_href, seller_username,
-                   condition_display_name, category_id, category_name, brand, last_seen_utc,
-                   ai_price_estimate
-            FROM public.ebay_items
-            ORDER BY (ai_price_estimate IS NULL) DESC, last_seen_utc DESC
-            LIMIT 200
-        """)).mappings().all()
-
-    for i in range(0, len(rows), batch):
-        subset = [dict(r) for r in rows[i:i+batch]]
-        preds = predict_prices_with_gemini(subset)
-        for r, p in zip(subset, preds):
-            r["ai_price_estimate"] = p
-        try:
-            upsert_items(subset)
-            print(f"[AI] upsert {len(subset)} kayıt", flush=True)
-
-            # --- Telegram uyarısı kontrolü ---
-            for r in subset:
-                pv = r.get("price_value")
-                ai = r.get("ai_price_estimate")
-                if pv and ai:
-                    try:
-                        pv = float(pv)
-                        ai = float(ai)
-                        if ai >= pv * margin_rate:
-                            fark = (ai / pv - 1) * 100
-                            msg = (
-                                f"🔥 <b>Fiyat Uyarısı</b>\n\n"
-                                f"<b>{r.get('title')}</b>\n"
-                                f"Gerçek fiyat: <b>{pv:.2f}</b>\n"
-                                f"Tahmini değer: <b>{ai:.2f}</b>\n"
-                                f"Fark: <b>{fark:.1f}%</b>\n"
-                                f"🔗 <a href='{r.get('item_href')}'>Ürünü Gör</a>"
-                            )
-                            send_telegram_message(msg)
-                    except Exception as e:
-                        print(f"[WarnCheck] hata: {e}", flush=True)
+        if item_ids is None:
+            rows = conn.execute(text(BACKLOG_SELECT_SQL)).mappings().all()
+        else:
+            ids = sorted(item_ids)
+            rows = []
+            for i in range(0, len(ids), BULK_COPY_THRESHOLD):
+                rows += conn.execute(
+                    text(PREDICT_SELECT_SQL + f"WHERE {UNSCORED_SQL} AND item_id IN :ids")
+                    .bindparams(bindparam("ids", expanding=True)),
+                    {"ids": ids[i:i + BULK_COPY_THRESHOLD]}).mappings().all()
 
-        except Exception as e:
-            print(f"[AI] upsert hata: {e}", flush=True)
-        time.sleep(1)
+    rows = [dict(r) for r in rows]
+    scored, rows = score_items(rows, load_market_stats(rows))
+    update_market_scores(scored)
+    _alert_deals([r for r in scored if r["deal_score"] <= -MARKET_DEAL_Z])
+    print(f"[AI] piyasa puanı: {len(scored)} kesin, {len(rows)} Gemini'ye", flush=True)
+    if not GEMINI_API_KEY:
+        print("[AI] GEMINI_API_KEY yok; Gemini adımı atlandı.", flush=True)
+        return
+
+    # Partiler eşzamanlı gönderilir; her boş yuva için bir sonraki parti
+    # o anki uyarlanmış boyutla kesilir
+    pending = deque(rows)
+    cache_stats = Counter()
+    with ThreadPoolExecutor(max_workers=GEMINI_MAX_CONCURRENCY) as pool:
+        running = set()
+        while pending or running:
+            while pending and len(running) < GEMINI_MAX_CONCURRENCY:
+                running.add(pool.submit(_predict_batch, gemini_batcher.take(pending)))
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                try:
+                    subset, stats = fut.result()
+                    cache_stats += stats
+                    update_price_estimates(subset)
+                    print(f"[AI] tahmin yazıldı: {len(subset)} kayıt (parti={gemini_batcher.size})", flush=True)
+                    _alert_deals(subset)
+                except Exception as e:
+                    print(f"[AI] parti hata: {e}", flush=True)
 
+    lookups = sum(cache_stats.values())
+    hits = cache_stats["hot"] + cache_stats["db"]
+    print(f"[AI] cache hit={hits} (sıcak={cache_stats['hot']}, db={cache_stats['db']}) "
+          f"miss={cache_stats['miss']} oran={hits / lookups if lookups else 0:.0%}", flush=True)
+    prediction_cache.evict()
     print("[AI] done", flush=True)
 
 
-def main():
+def job_pipeline():
+    """Ingest biter bitmez yalnızca yeni/değişen ürünler için tahmin çalışır."""
+    _, _, changed_ids = job_ingest_ebay()
+    job_predict_prices(changed_ids)
+
+
+# ------------------- Worker -------------------
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", "8080"))  # 0 = kapalı
+SCHED_MISFIRE_GRACE_SECONDS = int(os.getenv("SCHED_MISFIRE_GRACE_SECONDS", "300"))
+AI_BACKLOG_HOURS = float(os.getenv("AI_BACKLOG_HOURS", "6"))  # tahmini eksik kalanları tarama sıklığı
+
+worker_state = {"ready": False, "started_at": None, "jobs": {}}
+
+
+class _HealthHandler(BaseHTTPRequestHandler):
+    """/healthz: süreç ayakta mı; /readyz: şema hazır ve zamanlayıcı çalışıyor mu.
+
+    Yanıt gövdesi iş durumlarını ve bağlantı havuzu sayaçlarını (db_pool) içerir.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/healthz":
+            code = 200
+        elif self.path == "/readyz":
+            code = 200 if worker_state["ready"] else 503
+        else:
+            code = 404
+        body = json.dumps({**worker_state, "db_pool": db_pool_stats()}, default=str).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_health_server(port: int) -> ThreadingHTTPServer | None:
+    if not port:
+        return None
+    srv = ThreadingHTTPServer(("0.0.0.0", port), _HealthHandler)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, name="health", daemon=True).start()
+    print(f"[Worker] health endpoint :{port}/healthz, /readyz", flush=True)
+    return srv
+
+
+def _on_scheduler_event(event):
+    if event.code == EVENT_SCHEDULER_STARTED:
+        worker_state["ready"] = True
+        return
+    worker_state["jobs"][event.job_id] = {
+        "finished_at": datetime.now(timezone.utc),
+        "ok": event.exception is None,
+        "error": None if event.exception is None else str(event.exception),
+    }
+
+
+def run_once():
+    """Cron tarzı tek çalıştırma: ingest + tahmin, sonra çıkış."""
+    ensure_schema()
+    alert_dispatcher.resume()
+    job_pipeline()
+    alert_dispatcher.close()
+    if response_recorder is not None:
+        response_recorder.close()
+
+
+def run_worker():
+    """Uzun ömürlü worker: tek engine ve HTTP havuzu süreç boyunca kullanılır."""
+    worker_state["started_at"] = datetime.now(timezone.utc)
+    health = start_health_server(HEALTH_PORT)
     ensure_schema()
     send_telegram_message("🧪 Bot bağlandı: başlangıç testi")
+    alert_dispatcher.resume()
+
+    # max_instances=1: bir iş kendisiyle çakışmaz; coalesce: kaçan çalıştırmalar
+    # tek çalıştırmada birleşir; grace süresini aşan kaçırmalar atlanır
+    sched = BlockingScheduler(timezone="UTC", job_defaults={
+        "max_instances": 1, "coalesce": True, "misfire_grace_time": SCHED_MISFIRE_GRACE_SECONDS,
+    })
+    now = datetime.now(timezone.utc)
+    # Hat her tick'te çalışır; her sorgu kendi aralığı dolduğunda yoklanır
+    sched.add_job(job_pipeline, "interval", minutes=POLL_TICK_MINUTES, id="pipeline", next_run_time=now)
+    sched.add_job(job_predict_prices, "interval", hours=AI_BACKLOG_HOURS, id="ai-backlog")
+    sched.add_job(job_price_history_retention, "cron", hour=3, id="retention")
+    sched.add_listener(_on_scheduler_event, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_SCHEDULER_STARTED)
+
+    def _stop(signum, frame):
+        print(f"[Worker] sinyal {signum}, çalışan işler bitince kapanıyor", flush=True)
+        worker_state["ready"] = False
+        sched.shutdown(wait=True)
 
-    sched = BlockingScheduler(timezone="UTC")
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
 
-    sched.add_job(job_ingest_ebay, "interval", minutes=30, id="ingest")
-    sched.add_job(job_predict_prices, "interval", minutes=30, id="ai")
+    print(f"[Scheduler] running (tick={POLL_TICK_MINUTES:g} dk)", flush=True)
+    try:
+        sched.start()
+    finally:
+        if health:
+            health.shutdown()
+        alert_dispatcher.close()
+        if response_recorder is not None:
+            response_recorder.close()
+        http_client.close()
+        ingest_engine.dispose()
+        engine.dispose()
+        print("[Worker] kapandı", flush=True)
 
-    job_ingest_ebay()
-    job_predict_prices()
 
-    print("[Scheduler] running (every 30 min)", flush=True)
-    sched.start()
+def main():
+    parser = argparse.ArgumentParser(description="eBay ingest + Gemini fiyat tahmini worker'ı")
+    parser.add_argument("--once", action="store_true",
+                        help="ingest ve tahmini bir kez çalıştırıp çık (cron kullanımı için)")
+    parser.add_argument("--replay", nargs="+", metavar="DOSYA",
+                        help="kaydedilmiş yanıtları (.jsonl.gz/.jsonl/.json) ağ kullanmadan yükle ve çık")
+    parser.add_argument("--replay-query", metavar="ANAHTAR",
+                        help="tekrar oynatmada yalnızca bu query_key'e ait sayfalar")
+    args = parser.parse_args()
+    if args.replay:
+        job_replay(args.replay, args.replay_query)
+    elif args.once:
+        run_once()
+    else:
+        run_worker()
 
 
 if __name__ == "__main__":
     main()
-
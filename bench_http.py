@@ -0,0 +1,118 @@
+"""Ortak HTTP istemcisinin (keep-alive havuzu) bağlantı kazancını ölçer.
+
+Yerel bir stub sunucu bir ingest döngüsünü taklit eder: 1 token isteği,
+N arama sayfası ve M Telegram mesajı. Aynı döngü önce modül düzeyinde
+requests.get/post ile (her çağrı yeni bağlantı), sonra app.http_client ile
+çalıştırılır; açılan bağlantı sayısı, aktarılan bayt ve süre yazdırılır.
+
+Kullanım:
+    python bench_http.py --searches 50 --messages 10
+    python bench_http.py --certfile cert.pem --keyfile key.pem   # TLS el sıkışması dahil
+"""
+import os, ssl, gzip, json, time, argparse, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# app.py içe aktarılırken bu değişkenleri ister; benchmark DB ve eBay kullanmaz
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("EBAY_CLIENT_ID", "bench")
+os.environ.setdefault("EBAY_CLIENT_SECRET", "bench")
+
+import requests
+import app
+
+PAGE = json.dumps({"itemSummaries": [
+    {"itemId": f"v1|{i}|0", "title": f"Bench item {i}", "price": {"value": "10.00", "currency": "GBP"},
+     "seller": {"username": "seller"}, "categories": [{"categoryId": "9355", "categoryName": "Phones"}]}
+    for i in range(200)
+]}).encode()
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    connections = 0
+    bytes_sent = 0
+
+    def process_request(self, request, client_address):
+        type(self).connections += 1
+        super().process_request(request, client_address)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body: bytes):
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            self.send_response(200)
+            self.send_header("Content-Encoding", "gzip")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        StubServer.bytes_sent += len(body)
+
+    def do_GET(self):
+        self._reply(PAGE)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self._reply(b'{"access_token": "x", "expires_in": 7200, "ok": true}')
+
+
+def cycle(get, post, base: str, searches: int, messages: int):
+    post(f"{base}/identity/v1/oauth2/token", data={"grant_type": "client_credentials"})
+    for i in range(searches):
+        get(f"{base}/buy/browse/v1/item_summary/search", params={"q": "bench", "offset": i * 200}).json()
+    for i in range(messages):
+        post(f"{base}/bot/sendMessage", json={"chat_id": 1, "text": f"m{i}"})
+
+
+def measure(name: str, get, post, base: str, args):
+    StubServer.connections = StubServer.bytes_sent = 0
+    t = time.perf_counter()
+    cycle(get, post, base, args.searches, args.messages)
+    dt = time.perf_counter() - t
+    calls = 1 + args.searches + args.messages
+    print(f"{name:>14}: çağrı={calls} bağlantı={StubServer.connections} "
+          f"bayt={StubServer.bytes_sent:,} süre={dt * 1000:.0f}ms", flush=True)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--searches", type=int, default=50)
+    ap.add_argument("--messages", type=int, default=10)
+    ap.add_argument("--certfile")
+    ap.add_argument("--keyfile")
+    args = ap.parse_args()
+
+    srv = StubServer(("127.0.0.1", 0), StubHandler)
+    scheme = "http"
+    verify = True
+    if args.certfile:
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(args.certfile, args.keyfile)
+        srv.socket = ctx.wrap_socket(srv.socket, server_side=True)
+        scheme, verify = "https", False
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    base = f"{scheme}://127.0.0.1:{srv.server_address[1]}"
+
+    measure("requests.get",
+            lambda u, **kw: requests.get(u, verify=verify, timeout=30, **kw),
+            lambda u, **kw: requests.post(u, verify=verify, timeout=30, **kw),
+            base, args)
+    client = app.http_client
+    measure("http_client",
+            lambda u, **kw: client.get(u, verify=verify, **kw) if not client.http2 else client.get(u, **kw),
+            lambda u, **kw: client.post(u, verify=verify, **kw) if not client.http2 else client.post(u, **kw),
+            base, args)
+    srv.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Arama yanıtı çözümleme + flatten_item verim karşılaştırması.
+
+Kayıtlı yanıtlar (INGEST_RECORD_DIR altındaki .jsonl.gz dosyaları) verilirse
+onların gövdeleri, verilmezse gerçekçi boyutta sentetik 200 ürünlük sayfalar
+kullanılır. Her çözümleyici için sayfa/sn, ürün/sn, çözümleme+flatten ürün/sn
+ve tracemalloc ile sayfa başına en yüksek bellek yazdırılır.
+
+Kullanım:
+    python bench_parse.py --pages 200
+    python bench_parse.py records/ebay-search-20240501T10.jsonl.gz
+"""
+import os, gzip, json, time, argparse, tracemalloc
+
+# app.py içe aktarılırken bu değişkenleri ister; benchmark DB ve eBay kullanmaz
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("EBAY_CLIENT_ID", "bench")
+os.environ.setdefault("EBAY_CLIENT_SECRET", "bench")
+
+import app
+
+
+def synthetic_page(n: int = 200, page: int = 0) -> bytes:
+    items = [{
+        "itemId": f"v1|{page}{i:03d}|0",
+        "title": f"Apple iPhone 13 128GB Blue Unlocked #{i}",
+        "leafCategoryIds": ["9355"],
+        "categories": [{"categoryId": "9355", "categoryName": "Mobile & Smart Phones"},
+                       {"categoryId": "15032", "categoryName": "Mobile Phones & Communication"}],
+        "image": {"imageUrl": f"https://i.ebayimg.com/images/g/{i}/s-l225.jpg"},
+        "additionalImages": [{"imageUrl": f"https://i.ebayimg.com/images/g/{i}/{k}.jpg"} for k in range(6)],
+        "price": {"value": f"{300 + i % 50}.00", "currency": "GBP"},
+        "itemHref": f"https://api.ebay.com/buy/browse/v1/item/v1%7C{page}{i:03d}%7C0",
+        "seller": {"username": f"seller{i % 37}", "feedbackPercentage": "99.2", "feedbackScore": 1200 + i},
+        "condition": "Used", "conditionId": "3000",
+        "thumbnailImages": [{"imageUrl": f"https://i.ebayimg.com/thumbs/{i}.jpg"}],
+        "shippingOptions": [{"shippingCostType": "FIXED", "shippingCost": {"value": "0.00", "currency": "GBP"}}],
+        "buyingOptions": ["FIXED_PRICE", "BEST_OFFER"],
+        "itemWebUrl": f"https://www.ebay.co.uk/itm/{page}{i:03d}",
+        "itemLocation": {"postalCode": "SW1***", "country": "GB"},
+        "adultOnly": False, "legacyItemId": f"{page}{i:03d}",
+        "availableCoupons": False, "itemCreationDate": "2024-05-01T10:00:00.000Z",
+        "topRatedBuyingExperience": False, "priorityListing": False, "listingMarketplaceId": "EBAY_GB",
+        "shortDescription": "Excellent condition, fully working, comes with charger. " * 3,
+    } for i in range(n)]
+    return json.dumps({"href": "https://api.ebay.com/...", "total": 10000, "next": "https://api.ebay.com/next",
+                       "limit": n, "offset": page * n, "itemSummaries": items}).encode()
+
+
+def load_pages(paths: list[str], limit: int) -> list[bytes]:
+    pages = []
+    for path in paths:
+        with gzip.open(path, "rt", encoding="utf-8") if path.endswith(".gz") else open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    pages.append(json.dumps(json.loads(line)["body"]).encode())
+                if len(pages) >= limit:
+                    return pages
+    return pages
+
+
+def bench(name: str, pages: list[bytes], flatten: bool, per_page_ts: bool) -> tuple[float, float]:
+    app.EBAY_JSON_PARSER = name
+    items = 0
+    t = time.perf_counter()
+    for content in pages:
+        body = app.parse_search_page(content) if name != "raw" else json.loads(content)
+        page = body.get("itemSummaries") or []
+        items += len(page)
+        if flatten:
+            seen_at = app._utcnow() if per_page_ts else None
+            for it in page:
+                app.flatten_item(it, seen_at)
+    dt = time.perf_counter() - t
+    return len(pages) / dt, items / dt
+
+
+def peak_kib(name: str, content: bytes) -> float:
+    app.EBAY_JSON_PARSER = name
+    tracemalloc.start()
+    body = app.parse_search_page(content) if name != "raw" else json.loads(content)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del body
+    return peak / 1024
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("records", nargs="*", help="ResponseRecorder .jsonl(.gz) dosyaları")
+    ap.add_argument("--pages", type=int, default=200)
+    args = ap.parse_args()
+
+    pages = load_pages(args.records, args.pages) if args.records else [synthetic_page(200, p) for p in range(args.pages)]
+    size = sum(map(len, pages)) / len(pages) / 1024
+    print(f"sayfa={len(pages)} ortalama={size:.0f} KiB", flush=True)
+
+    # raw: eski yol (r.json() + ürün başına datetime.now())
+    parsers = ["raw", "json"] + [p for p in ("orjson", "ijson") if getattr(app, p) is not None]
+    print(f"{'çözümleyici':>12} {'sayfa/s':>9} {'ürün/s':>11} {'+flatten ürün/s':>16} {'tepe KiB':>9}", flush=True)
+    bench("raw", pages[:10], flatten=True, per_page_ts=False)  # ısınma
+    for name in parsers:
+        pps, ips = bench(name, pages, flatten=False, per_page_ts=False)
+        _, fps = bench(name, pages, flatten=True, per_page_ts=name != "raw")
+        print(f"{name:>12} {pps:>9,.0f} {ips:>11,.0f} {fps:>16,.0f} {peak_kib(name, pages[0]):>9,.0f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Başlık kümelemesinin farklı ürünleri birleştirmediğini doğrular.
+
+Bellek içi SQLite'ta şema göçleri kurulur ve başlık çiftleri
+assign_product_clusters'tan geçirilir: aynı ürün olması gereken çiftler aynı
+kümeye, farklı model/varyant/aksesuar çiftleri ayrı kümelere düşmelidir.
+Beklenti tutmazsa çıkış kodu 1'dir. Ağ ve gerçek veritabanı kullanılmaz.
+
+Kullanım:
+    python check_clusters.py
+"""
+import os, sys
+
+# app.py içe aktarılırken bu değişkenleri ister
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("EBAY_CLIENT_ID", "check")
+os.environ.setdefault("EBAY_CLIENT_SECRET", "check")
+
+import app
+
+BASE = "Apple iPhone 13 128GB Blue Unlocked"
+# (başlık a, başlık b, aynı küme mi)
+PAIRS = [
+    (BASE, "Apple iPhone 13 128GB Unlocked Blue Smartphone", True),
+    (BASE, "Apple iPhone 13 128GB Blue Unlocked with Charger", True),
+    (BASE, "Apple iPhone 14 128GB Blue Unlocked", False),
+    (BASE, "Apple iPhone 13 Pro Max 128GB Blue Unlocked", False),
+    (BASE, "Apple iPhone 13 Mini 128GB Blue Unlocked", False),
+    (BASE, "Apple iPhone 13 256GB Blue Unlocked", False),
+    (BASE, "Apple iPhone 13 128GB Case Blue Unlocked", False),
+    (BASE, "Screen Protector for Apple iPhone 13 128GB Blue", False),
+    ("Apple iPhone 13 Pro Max 128GB Graphite", "Apple iPhone 13 Pro 128GB Graphite", False),
+    ("Sony PS5 Console Disc Edition White", "Sony PlayStation 5 Console Disc Edition White", True),
+    ("Sony PS5 Console Disc Edition White", "Sony PS4 Console Disc Edition White", False),
+    ("Apple iPhone 13 Silicone Case Blue", "Apple iPhone 13 Charger Cable Blue", False),
+]
+
+
+def main():
+    eng = app.make_engine("sqlite://", "check-clusters")
+    failed = 0
+    with eng.connect() as conn:
+        app.migrate_schema(conn)
+        for a, b, same in PAIRS:
+            # Her çift boş küme tablolarıyla başlar; a kümeyi açar, b ona katılır ya da yenisini açar
+            with conn.begin():
+                conn.execute(app.text("DELETE FROM product_cluster_lsh"))
+                conn.execute(app.text("DELETE FROM product_clusters"))
+                ra, rb = {"title": a}, {"title": b}
+                app.assign_product_clusters(conn, [ra])
+                app.assign_product_clusters(conn, [rb])
+            ok = (ra["product_cluster_id"] == rb["product_cluster_id"]) == same
+            failed += not ok
+            print(f"[Check] {'OK ' if ok else 'HATA'} {'aynı' if same else 'ayrı'}: {a!r} / {b!r}", flush=True)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()